@@ -1,22 +1,42 @@
-import inspect
+import bisect
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
 import operator
-import queue
+import os
 import threading
+import time
 import uuid
+import weakref
 from dataclasses import dataclass
+from types import MappingProxyType
 
 import flet as ft
 from flet_core.canvas import CanvasResizeEvent
 
+try:
+    import numpy as np
+except ImportError:  # Optional, AnchorGrid falls back to plain Python
+    np = None
+
+try:
+    import kiwisolver
+except ImportError:  # Optional, only needed for the linear engine
+    kiwisolver = None
+
 
 LEFT, RIGHT, TOP, BOTTOM, WIDTH, HEIGHT, CENTER_X, CENTER_Y = (
         "left", "right", "top", "bottom", "width", "height", "center_x", "center_y"
     )
+X, Y = "x", "y"
 
 
 def _anchor_prop(attribute):
     return property(
-        lambda self: Anchor(self, attribute),
+        lambda self: Anchor.reference(self, attribute),
         lambda self, value: self._anchors.set_anchor(attribute, value),
     )
 
@@ -38,6 +58,7 @@ def _align_prop(attribute):
 class Anchored(ft.canvas.Canvas):
     DEFAULT_GAP = 10
     DEFAULT_PADDING = 10
+    RESIZE_INTERVAL = 1 / 30  # Seconds between layouts while resize events keep coming, 0 to lay out every event
 
     def __init__(
         self,
@@ -85,54 +106,61 @@ class Anchored(ft.canvas.Canvas):
         self._anchors = AnchorManager(self)
         super().__init__(content=content, **kwargs)
 
-        if parent:
-            if type(parent) is AnchorStack:
+        if parent and type(parent) is not AnchorStack:
+            raise ValueError(f"parent should be of type AnchorStack, not {type(parent)}")
+
+        with self._anchors.defer():
+            if parent:  # In the same batch as the anchors, so that joining the stack does not take a pass of its own
                 parent.content.controls.append(self)
                 self._anchors.parent = parent
-            else:
-                raise ValueError(f"parent should be of type AnchorStack, not {type(parent)}")
-
-        self.gap = gap
-
-        self.top = top
-        self.bottom = bottom
-        self.left = left
-        self.right = right
-        self.width = width
-        self.height = height
-        self.center_x = center_x
-        self.center_y = center_y
-        self.align_top = align_top
-        self.align_bottom = align_bottom
-        self.align_left = align_left
-        self.align_right = align_right
-        self.align_width = align_width
-        self.align_height = align_height
-        self.align_center_x = align_center_x
-        self.align_center_y = align_center_y
-        self.dock_top_left = dock_top_left
-        self.dock_top_right = dock_top_right
-        self.dock_bottom_left = dock_bottom_left
-        self.dock_bottom_right = dock_bottom_right
-        self.dock_top_center = dock_top_center
-        self.dock_bottom_center = dock_bottom_center
-        self.dock_left_center = dock_left_center
-        self.dock_right_center = dock_right_center
-        self.dock_sides = dock_sides
-        self.dock_top_bottom = dock_top_bottom
-        self.dock_top = dock_top
-        self.dock_left = dock_left
-        self.dock_bottom = dock_bottom
-        self.dock_right = dock_right
-        self.dock_center = dock_center
-        self.dock_all = dock_all
-        self.dock_above = dock_above
-        self.dock_below = dock_below
-        self.dock_right_of = dock_right_of
-        self.dock_left_of = dock_left_of
+
+            self.gap = gap
+
+            self.top = top
+            self.bottom = bottom
+            self.left = left
+            self.right = right
+            self.width = width
+            self.height = height
+            self.center_x = center_x
+            self.center_y = center_y
+            self.align_top = align_top
+            self.align_bottom = align_bottom
+            self.align_left = align_left
+            self.align_right = align_right
+            self.align_width = align_width
+            self.align_height = align_height
+            self.align_center_x = align_center_x
+            self.align_center_y = align_center_y
+            self.dock_top_left = dock_top_left
+            self.dock_top_right = dock_top_right
+            self.dock_bottom_left = dock_bottom_left
+            self.dock_bottom_right = dock_bottom_right
+            self.dock_top_center = dock_top_center
+            self.dock_bottom_center = dock_bottom_center
+            self.dock_left_center = dock_left_center
+            self.dock_right_center = dock_right_center
+            self.dock_sides = dock_sides
+            self.dock_top_bottom = dock_top_bottom
+            self.dock_top = dock_top
+            self.dock_left = dock_left
+            self.dock_bottom = dock_bottom
+            self.dock_right = dock_right
+            self.dock_center = dock_center
+            self.dock_all = dock_all
+            self.dock_above = dock_above
+            self.dock_below = dock_below
+            self.dock_right_of = dock_right_of
+            self.dock_left_of = dock_left_of
 
         self.on_resize = self._anchors.on_resize
 
+    def batch(self):
+        """
+        Context manager that collects all anchor changes made within it and lays them out once at the end.
+        """
+        return self._anchors.defer()
+
     def is_contained_in(self, source):
         return isinstance(source.content, ft.Stack) and self in source.content.controls
 
@@ -189,8 +217,9 @@ class Anchored(ft.canvas.Canvas):
 class AnchorStack(Anchored):
 
     DEFAULT_PADDING = 0
+    ENGINES = ("cascade", "linear")
 
-    def __init__(self, controls=None, padding=None, **kwargs):
+    def __init__(self, controls=None, padding=None, engine=None, **kwargs):
         controls = controls or []
         for control in controls or []:
             control.left = 0
@@ -198,9 +227,30 @@ class AnchorStack(Anchored):
 
         super().__init__(content=content, **kwargs)
 
-        self._wrap_controls()
+        self.controls = controls
 
         self.padding = padding
+        if engine is not None:
+            self.engine = engine
+
+    @property
+    def engine(self):
+        """
+        How the anchors of the controls directly in this stack are solved: "cascade", the default, evaluates them one
+        by one in dependency order, "linear" solves them together as linear constraints. The linear engine needs
+        kiwisolver.
+        """
+        return "cascade" if self._anchors.linear is None else "linear"
+
+    @engine.setter
+    def engine(self, value):
+        if value not in self.ENGINES:
+            raise ValueError(f"engine should be one of {self.ENGINES}, not {value!r}")
+        if value == "linear" and kiwisolver is None:
+            raise ImportError("The linear engine needs kiwisolver, install it with: pip install kiwisolver")
+        self._anchors.linear = LinearLayout(self) if value == "linear" else None
+        self._anchors.layout.tasks.append({"relayout": self._anchors})
+        self._anchors.process_queue()
 
     @property
     def controls(self):
@@ -208,16 +258,128 @@ class AnchorStack(Anchored):
 
     @controls.setter
     def controls(self, value):
-        self.content.controls = value
+        previous = self.content.controls or []
+        value = list(value or [])
+        self.content.controls = AnchorList(self, value)
+        self._controls_changed(added=value, removed=previous)
+
+    def _controls_changed(self, added=(), removed=()):
+        """
+        Registers the added controls with this stack and deregisters the removed ones, then lays out and updates the
+        stack once.
+        """
+        manager = self._anchors
+        with manager.defer():
+            current = {id(control) for control in self.content.controls} if removed else ()
+            for control in removed:
+                if isinstance(control, Anchored) and id(control) not in current:
+                    manager.remove_child(control)
+            for control in added:
+                if isinstance(control, Anchored):
+                    manager.add_child(control)
+            manager.layout.updated_controls[manager.id] = self
+
+    def solve(self, width, height, measure=None):
+        """
+        Lays out the stack and everything in it for the given size without a page or a client, e.g. to precompute
+        layouts or to test them at different sizes.
+
+        measure(control) should return the (width, height) the client would report for a control whose size is not
+        set by anchors, default is (0, 0).
+
+        Returns a dict of control: {"left", "top", "width", "height"}, relative to the stack the control is in.
+        """
+        return self._anchors.solve_headless(width, height, measure)
+
+    def dependent_counts(self):
+        """
+        Returns the number of controls registered as depending on each control in this stack, including the stack
+        itself. Handy for checking that removed or re-anchored controls are no longer tracked.
+        """
+        return {control: len(control._anchors.source_for) for control in (self, *self._anchors.descendants())}
+
+    def enable_stats(self, callback=None):
+        """
+        Starts collecting layout statistics for the whole tree under the root stack.
+        callback, if given, is called with the LayoutStats of every layout pass.
+        Returns the LayoutStats object with the totals.
+        """
+        layout = self._anchors.layout
+        layout.stats = LayoutStats()
+        layout.stats_callback = callback
+        return layout.stats
+
+    def disable_stats(self):
+        layout = self._anchors.layout
+        layout.stats = None
+        layout.stats_callback = None
+
+    def enable_snapshots(self, size=8, quantum=1):
+        """
+        Keeps the solved layout of the whole tree for up to size recent root stack sizes, so that going back to a size,
+        e.g. when maximizing and restoring a window, applies the stored values instead of solving again. Sizes are
+        rounded to multiples of quantum, and told apart by which conditions hold at the exact size. Any change to anchors,
+        attributes or controls drops the stored layouts. Trees with hysteresis conditions, conditions on anything but
+        the root stack size, or virtual grids are always solved.
+        """
+        layout = self._anchors.layout
+        layout.snapshots = collections.OrderedDict()
+        layout.snapshot_conditions = None
+        layout.snapshot_size = size
+        layout.snapshot_quantum = quantum
+
+    def disable_snapshots(self):
+        layout = self._anchors.layout
+        layout.snapshots = None
+        layout.snapshot_key = layout.snapshot_root = layout.snapshot_conditions = None
+
+    def enable_tracing(self, max_events=100_000):
+        """
+        Starts recording the layout passes of the whole tree under the root stack as timed spans: passes, the anchor
+        of each control and attribute that is recalculated, with-block condition checks and page updates.
+        Returns the LayoutTracer, whose save() writes the spans as a Chrome Trace Event file that can be opened in
+        Perfetto or chrome://tracing. Only the latest max_events spans are kept.
+        """
+        layout = self._anchors.layout
+        layout.tracer = LayoutTracer(max_events)
+        return layout.tracer
+
+    def disable_tracing(self):
+        self._anchors.layout.tracer = None
+
+    def enable_compiled_layout(self):
+        """
+        Generates the layout of the whole tree under the root stack as one Python function of the root size, and uses
+        it for passes that only resize the root. Any change to anchors, attributes or controls drops the function, and
+        it is generated again on the next resize. AnchorStack.solve uses it too. The source of the current function is
+        in layout_source.
+        Trees with the linear engine, virtual grids or hysteresis conditions are always solved as usual.
+        """
+        layout = self._anchors.layout
+        layout.compiled = True
+        layout.plan = None
+
+    def disable_compiled_layout(self):
+        layout = self._anchors.layout
+        layout.compiled = False
+        layout.plan = None
 
-        for control in self.content.controls:
-            if type(control) is Anchored:
-                control._anchors.parent = self
-
-    def _wrap_controls(self):
-        tracked_list = AnchorList(self.controls)
-        tracked_list.stack = self
-        self.controls = tracked_list
+    @property
+    def layout_source(self):
+        plan = self._anchors.layout.plan
+        return plan.source if plan else None
+
+    def enable_async(self, loop=None):
+        """
+        Switches the whole tree under the root stack to asynchronous layout, for async flet apps. Changes and resize
+        events are then queued and laid out in one pass per event loop iteration, sent with page.update_async().
+        Resize events are still throttled to one layout per RESIZE_INTERVAL. Call from within the event loop, or give
+        the loop.
+        """
+        self._anchors.layout.loop = loop or asyncio.get_running_loop()
+
+    def disable_async(self):
+        self._anchors.layout.loop = None
 
     @property
     def padding(self):
@@ -229,10 +391,369 @@ class AnchorStack(Anchored):
         self._anchors.set_attribute("padding", value)
 
 
+class AnchorGrid(AnchorStack):
+    """
+    Stack that places its controls in equally sized cells, row by row, separated by the gap and inset by the padding.
+    columns=None puts all the controls in one row, columns=1 in one column.
+
+    The cells are calculated for all the controls at once per layout pass, as NumPy array operations if NumPy is
+    installed, and only the controls whose cell changed are updated. Controls in the grid should not have anchors of
+    their own, but other controls can be anchored to them.
+    """
+
+    def __init__(self, controls=None, columns=None, **kwargs):
+        self._columns = columns
+        self._cells = None  # Cells from the previous pass, to find the ones that changed
+        super().__init__(**kwargs)
+        self.controls = controls or []
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @columns.setter
+    def columns(self, value):
+        self._columns = value
+        self._relayout()
+
+    def _relayout(self):
+        self._anchors.layout.tasks.append({"relayout": self._anchors})
+        self._anchors.process_queue()
+
+    def _controls_changed(self, added=(), removed=()):
+        self._cells = None
+        with self._anchors.defer():
+            super()._controls_changed(added, removed)
+            self._anchors.layout.tasks.append({"relayout": self._anchors})
+
+    def _arrange(self, to_update, stats=None):
+        actuals = self._anchors.actuals
+        controls = [control for control in self.content.controls if isinstance(control, Anchored)]
+        if not controls or actuals.width is None or actuals.height is None:
+            return
+
+        count = len(controls)
+        columns = min(self._columns or count, count)
+        rows = -(-count // columns)
+        gap = self.gap
+        padding = self.padding
+        width = (actuals.width - (columns - 1) * gap - 2 * padding) / columns
+        height = (actuals.height - (rows - 1) * gap - 2 * padding) / rows
+
+        if np is not None:
+            index = np.arange(count)
+            cells = np.empty((count, 4))
+            cells[:, 0] = padding + index % columns * (width + gap)
+            cells[:, 1] = padding + index // columns * (height + gap)
+            cells[:, 2] = width
+            cells[:, 3] = height
+            previous = self._cells
+            if previous is None or previous.shape != cells.shape:
+                changed = index
+            else:
+                changed = np.flatnonzero((cells != previous).any(axis=1))
+            self._cells = cells
+            changed_cells = zip(changed.tolist(), cells[changed].tolist())
+        else:
+            cells = [
+                [padding + i % columns * (width + gap), padding + i // columns * (height + gap), width, height]
+                for i in range(count)
+            ]
+            previous = self._cells if self._cells is not None and len(self._cells) == count else [None] * count
+            changed_cells = [(i, cell) for i, cell in enumerate(cells) if cell != previous[i]]
+            self._cells = cells
+
+        for i, cell in changed_cells:
+            self._place(controls[i], cell, to_update, stats)
+
+    def _place(self, control, cell, to_update, stats=None):
+        left, top, width, height = cell
+        manager = control._anchors
+        manager.actuals.update(left=left, top=top, width=width, height=height)
+        manager.memo.clear()
+        control._set_attr("left", left)
+        control._set_attr("top", top)
+        control._set_attr("width", width)
+        control._set_attr("height", height)
+        manager.layout.updated_controls[manager.id] = control
+        if stats:
+            stats.set_attrs += 4
+        if manager.source_for:
+            manager.mark_dirty(to_update, stats)
+
+
+class AnchorVirtualGrid(AnchorGrid):
+    """
+    Grid for a sequence of items that can be far larger than the grid itself. Rows are item_height high and scrolled
+    with scroll_offset, and only the items in the visible rows, plus buffer rows above and below them, have a control.
+
+    create(item) returns a new Anchored for an item. If recycle(control, item) is given, controls of the items that
+    leave the visible rows are reused for the items that enter them, otherwise they are removed and new ones created.
+    """
+
+    def __init__(self, items, create, recycle=None, item_height=50, columns=1, buffer=2, **kwargs):
+        self._items = items
+        self._offset = 0
+        self._materialized = {}  # Item index: control
+        self._released = []  # Controls no longer showing an item, until reused or removed
+        self.create = create
+        self.recycle = recycle
+        self.item_height = item_height
+        self.buffer = buffer
+        super().__init__(columns=columns, **kwargs)
+
+    @property
+    def items(self):
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+        self._released.extend(self._materialized.values())
+        self._materialized = {}
+        self._relayout()
+
+    @property
+    def scroll_offset(self):
+        return self._offset
+
+    @scroll_offset.setter
+    def scroll_offset(self, value):
+        height = self._anchors.actuals.height
+        if height is not None:
+            value = min(value, self.content_height - height)
+        self._offset = max(0, value)
+        self._relayout()
+
+    @property
+    def content_height(self):
+        """
+        Height of all the rows together, whether they have controls or not.
+        """
+        rows = -(-len(self._items) // (self._columns or 1))
+        return max(0, rows * (self.item_height + self.gap) - self.gap) + 2 * self.padding
+
+    def _arrange(self, to_update, stats=None):
+        manager = self._anchors
+        actuals = manager.actuals
+        if actuals.width is None or actuals.height is None:
+            return
+
+        columns = self._columns or 1
+        gap = self.gap
+        padding = self.padding
+        row_height = self.item_height + gap
+        first_row = max(0, int((self._offset - padding) // row_height) - self.buffer)
+        last_row = int((self._offset + actuals.height - padding) // row_height) + self.buffer
+        visible = range(first_row * columns, min(len(self._items), (last_row + 1) * columns))
+
+        released = self._released
+        materialized = self._materialized
+        for index in [index for index in materialized if index not in visible]:
+            released.append(materialized.pop(index))
+
+        # Changes the controls list directly, as the AnchorList methods would start another layout pass
+        controls = self.content.controls
+        added = False
+        for index in visible:
+            if index not in materialized:
+                item = self._items[index]
+                if released and self.recycle:
+                    control = released.pop()
+                    self.recycle(control, item)
+                    manager.layout.updated_controls[control._anchors.id] = control  # Even if it keeps its cell
+                else:
+                    control = self.create(item)
+                    list.append(controls, control)
+                    manager.add_child(control)
+                    added = True
+                materialized[index] = control
+
+        if added or released:
+            removed = {id(control) for control in released}
+            for control in released:
+                manager.remove_child(control)
+            released.clear()
+            list.__setitem__(controls, slice(None), [control for control in controls if id(control) not in removed])
+            manager.layout.updated_controls[manager.id] = self
+
+        width = (actuals.width - (columns - 1) * gap - 2 * padding) / columns
+        for index, control in materialized.items():
+            cell = (
+                padding + index % columns * (width + gap),
+                padding + index // columns * row_height - self._offset,
+                width,
+                self.item_height,
+            )
+            current = control._anchors.actuals
+            if (current.left, current.top, current.width, current.height) != cell:
+                self._place(control, cell, to_update, stats)
+
+
+class Actuals:
+    """
+    Position and size of a control as last set by the layout or reported by the client, None when not known.
+    """
+    __slots__ = (LEFT, RIGHT, TOP, BOTTOM, WIDTH, HEIGHT)
+
+    def __init__(self):
+        self.left = self.right = self.top = self.bottom = self.width = self.height = None
+
+    def get(self, attribute, default=None):
+        value = getattr(self, attribute, None)  # Centers are not stored
+        return default if value is None else value
+
+    def __getitem__(self, attribute):
+        return getattr(self, attribute)
+
+    def __setitem__(self, attribute, value):
+        setattr(self, attribute, value)
+
+    def update(self, **values):
+        for attribute, value in values.items():
+            setattr(self, attribute, value)
+
+
+@dataclass
+class LayoutStats:
+    """
+    Counters for layout passes, either for a single pass or summed over all passes since stats were enabled.
+    """
+    passes: int = 0
+    queue_depth: int = 0  # Tasks processed
+    solve_duration: float = 0.0  # Seconds
+    resolves: int = 0  # Anchor evaluations
+    condition_evaluations: int = 0
+    set_attrs: int = 0
+    page_updates: int = 0
+    snapshot_hits: int = 0  # Passes restored from a layout snapshot instead of solved
+    compiled_passes: int = 0  # Passes laid out by the generated layout function
+
+    tracer = None  # LayoutTracer of the pass, when tracing, not a counter
+    started = 0.0
+
+    def add(self, other):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+class LayoutTracer:
+    """
+    Records layout work as complete events ("ph": "X") of the Chrome Trace Event format. Every span has the pass
+    number and the types of the tasks that triggered the pass in its args, spans for a control also the control and
+    attribute.
+    """
+
+    def __init__(self, max_events=100_000):
+        self.events = collections.deque(maxlen=max_events)
+        self.pid = os.getpid()
+        self.passes = 0
+        self.trigger = ""  # Task types of the current pass, e.g. "resize" or "attribute,set"
+
+    def add(self, name, category, start, manager=None, attribute=None):
+        """
+        Records a span from start, a time.perf_counter() value, to now.
+        """
+        end = time.perf_counter()
+        args = {"pass": self.passes, "trigger": self.trigger}
+        if manager is not None:
+            args["control"] = self.label(manager)
+        if attribute is not None:
+            args["attribute"] = attribute
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1_000_000,
+            "dur": (end - start) * 1_000_000,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+    @staticmethod
+    def label(manager):
+        control = manager.managed
+        kind = type(control).__name__ if isinstance(control, AnchorStack) else type(control.content).__name__
+        return f"{kind} {manager.id}"
+
+    def trace(self):
+        return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self, file_path):
+        with open(file_path, "w") as file:
+            json.dump(self.trace(), file)
+
+    def clear(self):
+        self.events.clear()
+
+
+class LayoutQueue:
+    """
+    Task queue and lock shared by all the controls under one root AnchorStack, so that independent sessions do not
+    wait for or process each other's layout.
+    """
+
+    GENERATIONS = itertools.count(1)  # Unique across queues, so that memos from another tree never look current
+    MAX_STALE_PASSES = 3  # Async passes whose updates can be held back by newer changes before they are sent anyway
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tasks = collections.deque()  # Appending and popping are thread-safe
+        self.deferred = 0
+        self.headless = 0
+        self.updated_controls = {}  # Controls with changes to send to the client at the end of processing
+        self.stats = None  # LayoutStats totals when enabled
+        self.stats_callback = None
+        self.tracer = None  # LayoutTracer when enabled
+        self.compiled = False  # Whether passes that only resize the root use a generated LayoutPlan
+        self.plan = None  # The LayoutPlan, None until generated, False if the tree cannot be compiled
+        self.loop = None  # Event loop when laying out asynchronously
+        self.snapshots = None  # Solved trees by root size, OrderedDict used as an LRU cache when enabled
+        self.snapshot_size = 0
+        self.snapshot_quantum = 1
+        self.snapshot_key = None
+        self.snapshot_root = None
+        self.snapshot_conditions = None  # Compiled conditions of the tree for the key, False if they cannot be used
+        self.async_scheduled = False
+        self.async_task = None
+        self.stale_passes = 0  # Async passes solved since the last update was sent
+        self.generation = 0  # Current layout round, invalidates the memoized source values of previous rounds
+        self.merged_into = None  # The root's queue that took over the pending work when the root joined a stack
+
+    def start_pass(self):
+        if self.stats is None and self.tracer is None:
+            return None
+        stats = LayoutStats(passes=1)
+        if self.tracer is not None:
+            stats.tracer = self.tracer
+            stats.started = time.perf_counter()
+            self.tracer.passes += 1
+            self.tracer.trigger = ""
+        return stats
+
+    def finish_pass(self, stats):
+        if stats is None:
+            return
+        if stats.tracer is not None:
+            stats.tracer.add("layout pass", "pass", stats.started)
+        if self.stats is None:
+            return
+        self.stats.add(stats)
+        if self.stats_callback:
+            self.stats_callback(stats)
+
+
 class AnchorManager:
-    UPDATE_LOCK = threading.RLock()
-    UPDATE_QUEUE = queue.Queue()
+    __slots__ = (
+        "id", "managed", "parent", "gap", "padding", "anchors", "conditions", "conditional_anchors", "active_contexts",
+        "conditions_dirty", "_condition_index", "condition_timer", "memo", "memo_generation", "source_for", "actuals",
+        "dirty", "_dependencies", "_nodes", "resize_scheduler", "_layout", "references", "linear",
+    )
 
+    IDS = itertools.count()
+    LAYOUT_CREATION_LOCK = threading.Lock()
+    EMPTY = MappingProxyType({})  # Shared placeholder for the dicts that most controls never need
     SETTERS = {
         LEFT: lambda value, anchors, actuals, parent_actuals: {"left": value},
         RIGHT: lambda value, anchors, actuals, parent_actuals: {"right": parent_actuals.get("width", 0) - value},
@@ -262,6 +783,26 @@ class AnchorManager:
 
     PARENT = "parent"
 
+    # Centers come last, as their setters depend on the other actuals of the same axis
+    ATTRIBUTE_ORDER = (LEFT, RIGHT, TOP, BOTTOM, WIDTH, HEIGHT, CENTER_X, CENTER_Y)
+
+    AXIS = {
+        LEFT: X,
+        RIGHT: X,
+        WIDTH: X,
+        CENTER_X: X,
+        TOP: Y,
+        BOTTOM: Y,
+        HEIGHT: Y,
+        CENTER_Y: Y,
+    }
+
+    CENTERS = {X: CENTER_X, Y: CENTER_Y}
+
+    MAX_HEADLESS_ROUNDS = 10
+    MAX_PREDICTION_ROUNDS = 10  # Sweeps per pass to size nested stacks, one per level of nesting
+
+
     DOCK_PARENT = {
         "dock_top_left": [TOP, LEFT],
         "dock_top_right": [TOP, RIGHT],
@@ -289,19 +830,83 @@ class AnchorManager:
     }
 
     def __init__(self, managed, **kwargs):
-        self.uuid = uuid.uuid4()
+        self.id = next(self.IDS)
         self.managed = managed
         self.parent = None
         self.gap = None
         self.padding = None
         self.anchors = {}
-        self.conditions = {}
-        self.conditional_anchors = {}
-        self.source_for = {}
-        self.actuals = {}
+        self.conditions = self.EMPTY
+        self.conditional_anchors = self.EMPTY
+        self.active_contexts = ()
+        self.conditions_dirty = False
+        self._condition_index = None
+        self.condition_timer = None
+        self.memo = {}
+        self.memo_generation = 0
+        self.source_for = self.EMPTY
+        self.actuals = Actuals()
+        self.dirty = set()
+        self._dependencies = {}
+        self._nodes = None
+        self.resize_scheduler = None
+        self._layout = None  # Created when needed, if this is the root
+        self.references = self.EMPTY  # Attribute: shared Anchor
+        self.linear = None  # LinearLayout for the controls in the managed stack, if it uses the linear engine
+
+    @property
+    def layout(self):
+        manager = self
+        while manager.parent is not None:
+            manager = manager.parent._anchors
+        if manager._layout is None:
+            with self.LAYOUT_CREATION_LOCK:
+                if manager._layout is None:
+                    manager._layout = LayoutQueue()
+        return manager._layout
+
+    def add_child(self, control):
+        child = control._anchors
+        child.parent = self.managed
+        child.release_layout()
+        self.register(control)
+        for source, _ in child.sources():  # Undoes remove_child, if the control was in a stack before
+            if source is not control:
+                source._anchors.register(control)
+        self.layout.tasks.append({"relayout": child})
+
+    def remove_child(self, control):
+        child = control._anchors
+        if child.parent is not self.managed:
+            return
+        self.unregister(control)
+        for source, _ in child.sources():
+            source._anchors.unregister(control)
+        self.layout.updated_controls.pop(child.id, None)
+        child.parent = None
+        child.dirty.clear()
+        child.memo.clear()
+
+    def release_layout(self):
+        # Once in a stack, the root's layout queue is used instead, and takes over the pending tasks and batches
+        layout = self._layout
+        if layout is None:
+            return
+        self._layout = None
+        if not (layout.tasks or layout.deferred or layout.updated_controls):
+            return
+        root = self.layout
+        with root.lock:
+            root.tasks.extend(layout.tasks)
+            root.deferred += layout.deferred
+            root.updated_controls.update(layout.updated_controls)
+            layout.tasks.clear()
+            layout.deferred = 0
+            layout.updated_controls.clear()
+            layout.merged_into = root
 
     def check_dock(self, attribute):
-        return all(self.anchors[dock_attribute] for dock_attribute in self.DOCK_PARENT[attribute])
+        return all(self.anchors.get(dock_attribute) for dock_attribute in self.DOCK_PARENT[attribute])
 
     def set_dock(self, attribute, other):
         if other is None:
@@ -309,11 +914,11 @@ class AnchorManager:
 
         if attributes := self.DOCK_PARENT.get(attribute):
             for dock_attribute in attributes:
-                self.UPDATE_QUEUE.put({"set": (self, dock_attribute, Anchor(other, dock_attribute))})
+                self.queue_set(dock_attribute, Anchor.reference(other, dock_attribute))
         else:
             center, my_edge, your_edge = self.DOCK_PEER[attribute]
-            self.UPDATE_QUEUE.put({"set": (self, center, Anchor(other, center))})
-            self.UPDATE_QUEUE.put({"set": (self, my_edge, Anchor(other, your_edge))})
+            self.queue_set(center, Anchor.reference(other, center))
+            self.queue_set(my_edge, Anchor.reference(other, your_edge))
 
         self.process_queue()
 
@@ -322,102 +927,1711 @@ class AnchorManager:
             return
 
         for other in others:
-            self.UPDATE_QUEUE.put({"set": (self, attribute, Anchor(other, attribute))})
+            self.queue_set(attribute, Anchor.reference(other, attribute))
         self.process_queue()
 
     def set_anchor(self, attribute, value):
-        self.UPDATE_QUEUE.put({"set": (self, attribute, value)})
+        self.queue_set(attribute, value)
         self.process_queue()
 
+    def queue_set(self, attribute, value):
+        # Conditions are captured now, as the queue may only be processed after the with block has exited
+        self.layout.tasks.append({"set": (self, attribute, value, Anchor.get_current_conditions())})
+
     def set_attribute(self, attribute, value):
-        self.UPDATE_QUEUE.put({"attribute": (self, attribute, value)})
+        self.layout.tasks.append({"attribute": (self, attribute, value)})
         self.process_queue()
 
     def register(self, dependent):
-        self.source_for[dependent._anchors.uuid] = dependent
+        if self.source_for is self.EMPTY:
+            self.source_for = {}
+        self.source_for[dependent._anchors.id] = dependent
+
+    def unregister(self, dependent):
+        if self.source_for is not self.EMPTY:
+            self.source_for.pop(dependent._anchors.id, None)
+
+    def sources(self):
+        """
+        Yields the (control, attribute) pairs used by any of the anchors or with-block conditions of this control.
+        """
+        for anchor in self.anchors.values():
+            yield from Anchor.sources(anchor)
+        for context_id, anchors in self.conditional_anchors.items():
+            yield from Anchor.sources(None, self.conditions[context_id])
+            for anchor in anchors.values():
+                yield from Anchor.sources(anchor)
+
+    def forget_sources(self, anchor):
+        """
+        Unregisters this control from the sources of a replaced anchor that no remaining anchor uses.
+        """
+        stale = {id(control): control for control, _ in Anchor.sources(anchor) if control is not self.managed}
+        if not stale:
+            return
+        for control, _ in self.sources():
+            stale.pop(id(control), None)
+        for control in stale.values():
+            if control is not self.parent:
+                control._anchors.unregister(self.managed)
+
+    @contextlib.contextmanager
+    def defer(self):
+        layout = self.layout
+        with layout.lock:
+            layout.deferred += 1
+            try:
+                yield self.managed
+            finally:
+                while layout.merged_into is not None:
+                    layout = layout.merged_into
+                layout.deferred -= 1
+                self.process_queue()  # Also if the block raised, so that its changes do not wait for the next pass
 
     def on_resize(self, event: CanvasResizeEvent):
-        self.UPDATE_QUEUE.put({"resize": (self, event.width, event.height)})
+        if not self.managed.RESIZE_INTERVAL:
+            self.resize(event.width, event.height)
+            return
+
+        if self.resize_scheduler is None:
+            self.resize_scheduler = ResizeScheduler(self.resize, self.managed.RESIZE_INTERVAL)
+        self.resize_scheduler.add(event.width, event.height)
+
+    def resize(self, width, height):
+        self.layout.tasks.append({"resize": (self, width, height)})
         self.process_queue()
 
     def process_queue(self):
-        with self.UPDATE_LOCK:
+        layout = self.layout
+        with layout.lock:
+            if layout.deferred:
+                return
+            if layout.loop is not None and not layout.headless:
+                self.schedule_async(layout)
+                return
+
+            stats = layout.start_pass()
+            self.run_tasks(layout, stats)
+            self.send_updates(layout, stats)
+            layout.finish_pass(stats)
+
+    @staticmethod
+    def schedule_async(layout):
+        # A running pass picks up the new tasks itself
+        if layout.async_task is None and not layout.async_scheduled:
+            layout.async_scheduled = True
+            layout.loop.call_soon_threadsafe(AnchorManager.start_async, layout)
+
+    @staticmethod
+    def start_async(layout):
+        layout.async_scheduled = False
+        if layout.async_task is None:
+            layout.async_task = layout.loop.create_task(AnchorManager.process_queue_async(layout))
+
+    @staticmethod
+    async def process_queue_async(layout):
+        """
+        Lays out everything queued during the current event loop iteration in one pass and sends it with one
+        page.update_async() per page. If newer changes arrive from other threads while the pass is solved, its update
+        is held back and sent together with the next one, but only for MAX_STALE_PASSES passes in a row, so that a
+        steady stream of changes cannot keep the client from ever being updated.
+        """
+        try:
             while True:
-                try:
-                    task = self.UPDATE_QUEUE.get_nowait()
-                    if "set" in task:
-                        manager, attribute, value = task["set"]
-                        if conditions_from_context := Anchor.get_current_conditions():
-                            context_id, current_conditions = conditions_from_context
-                            manager.conditions[context_id] = current_conditions
-                            manager.conditional_anchors.setdefault(context_id, {})[attribute] = value
-                        else:
-                            manager.anchors[attribute] = value
-
-                        if type(value) is Anchor:
-                            value._control._anchors.register(manager.managed)
-
-                        if manager.managed.page:  # If we are being displayed
-                            manager.update_anchor_actuals()
-
-                    elif "resize" in task:
-                        manager, width, height = task["resize"]
-
-                        manager.actuals["width"] = width
-                        manager.actuals["height"] = height
-                        manager.update_anchor_actuals()
-
-                    elif "attribute" in task:
-                        manager, attribute, value = task["attribute"]
-                        setattr(manager, attribute, value)
-                        manager.update_anchor_actuals()
-
-                except queue.Empty:
-                    break
+                await asyncio.sleep(0)  # Let the other handlers of this iteration queue their changes
+                with layout.lock:
+                    stats = layout.start_pass()
+                    AnchorManager.run_tasks(layout, stats)
+                    layout.stale_passes += 1
+                if not layout.tasks or layout.stale_passes >= LayoutQueue.MAX_STALE_PASSES:
+                    layout.stale_passes = 0
+                    await AnchorManager.send_updates_async(layout, stats)
+                layout.finish_pass(stats)
+                if not layout.tasks:
+                    return
+        finally:
+            layout.async_task = None
+            if layout.tasks and layout.loop is not None:  # Queued from another thread after the last check
+                AnchorManager.schedule_async(layout)
+
+    @staticmethod
+    def run_tasks(layout, stats=None):
+        if layout.snapshots is not None and AnchorManager.restore_snapshot(layout, stats):
+            return
+        if layout.compiled and AnchorManager.run_plan(layout, stats):
+            if layout.snapshots is not None:
+                AnchorManager.take_snapshot(layout)
+            return
+
+        to_update = {}
+        while layout.tasks:
+            task = layout.tasks.popleft()
+            if stats:
+                stats.queue_depth += 1
+                if stats.tracer is not None:
+                    stats.tracer.trigger = ",".join(sorted({*stats.tracer.trigger.split(","), *task} - {""}))
+            if "set" in task:
+                manager, attribute, value, conditions_from_context = task["set"]
+                if conditions_from_context:
+                    context_id, current_conditions = conditions_from_context
+                    if context_id not in manager.conditions:
+                        if manager.conditions is manager.EMPTY:
+                            manager.conditions, manager.conditional_anchors = {}, {}
+                        manager.conditions[context_id] = current_conditions
+                        manager._condition_index = None
+                        manager.conditions_dirty = True
+                    context_anchors = manager.conditional_anchors.setdefault(context_id, {})
+                    previous = context_anchors.get(attribute)
+                    context_anchors[attribute] = value
+                else:
+                    current_conditions = None
+                    if value is None:
+                        previous = manager.anchors.pop(attribute, None)
+                    else:
+                        previous = manager.anchors.get(attribute)
+                        manager.anchors[attribute] = value
+
+                manager._dependencies.pop(attribute, None)
+                manager._nodes = None
+                for source, _ in Anchor.sources(value, current_conditions):
+                    if source is not manager.managed:
+                        source._anchors.register(manager.managed)
+                if previous is not None:
+                    manager.forget_sources(previous)
+
+                if manager.managed.page:  # If we are being displayed
+                    manager.dirty.add(attribute)
+                    to_update[manager.id] = manager
+
+            elif "resize" in task:
+                manager, width, height = task["resize"]
+                if manager.parent is not None and (manager.actuals.width, manager.actuals.height) == (width, height):
+                    continue  # Echo of a size that the layout already predicted
+
+                manager.actuals["width"] = width
+                manager.actuals["height"] = height
+                manager.mark_dirty(to_update, stats)
+
+            elif "attribute" in task:
+                manager, attribute, value = task["attribute"]
+                setattr(manager, attribute, value)
+
+                if manager.managed.page:
+                    manager.mark_dirty(to_update, stats)
+
+            elif "relayout" in task:
+                manager = task["relayout"]
+                if manager.managed.page:
+                    manager.mark_dirty(to_update, stats)
+
+            elif "conditions" in task:
+                manager = task["conditions"]
+                manager.conditions_dirty = True
+                to_update[manager.id] = manager
+
+        AnchorManager.solve(layout, to_update, stats)
+        if layout.snapshots is not None:
+            AnchorManager.take_snapshot(layout)
+
+    @staticmethod
+    def snapshot_key(layout, root):
+        """
+        Returns the key for the current root size, quantized, and the result of every condition in the tree for that
+        size, so that sizes rounding to the same key are still told apart by the breakpoints between them.
+        Returns None if the tree has state that a snapshot cannot restore.
+        """
+        if root.actuals.width is None or root.actuals.height is None:
+            return None
+        for control in root.descendants():
+            manager = control._anchors
+            if isinstance(control, AnchorVirtualGrid) or manager.condition_timer is not None:
+                return None
+            if manager.conditions and manager.condition_index().stateful:
+                return None
+        if layout.snapshot_conditions is None:
+            conditions = AnchorManager.snapshot_conditions(root)
+            layout.snapshot_conditions = False if conditions is None else conditions
+        if layout.snapshot_conditions is False:
+            return None
+        target = Anchor.TargetData(root.managed, TOP, root.managed)
+        quantum = layout.snapshot_quantum
+        return (
+            round(root.actuals.width / quantum),
+            round(root.actuals.height / quantum),
+            tuple(bool(check(target)) for check in layout.snapshot_conditions),
+        )
+
+    @staticmethod
+    def snapshot_conditions(root):
+        """
+        Returns the with-block and & | conditions of the tree compiled, or None if any of them depends on something
+        other than the size of the root stack, which is only known after the pass.
+        """
+        conditions = {}
+        for control in root.descendants():
+            manager = control._anchors
+            anchors = list(manager.anchors.values())
+            for context_id, condition_lists in manager.conditions.items():
+                for condition in (condition for condition_list in condition_lists for condition in condition_list):
+                    conditions[Anchor.structure_key(condition)] = condition
+                anchors.extend(manager.conditional_anchors.get(context_id, {}).values())
+            while anchors:
+                anchor = anchors.pop()
+                if type(anchor) is Anchor and anchor._real_conditions:
+                    for condition in anchor._conditions[0]._conditions:
+                        conditions[Anchor.structure_key(condition)] = condition
+                    anchors.append(anchor._alternative)
+
+        for condition in conditions.values():
+            if any(control is not root.managed for control, _ in Anchor.sources(condition)):
+                return None
+        return [Anchor.compile_value(condition, TOP) for condition in conditions.values()]
+
+    @staticmethod
+    def take_snapshot(layout):
+        """
+        Stores the solved tree under the key of the size it was last resized to.
+        """
+        root = layout.snapshot_root
+        if layout.snapshot_key is None or root is None:
+            return
+        layout.snapshots[layout.snapshot_key] = AnchorManager.capture(root.descendants())
+        layout.snapshots.move_to_end(layout.snapshot_key)
+        while len(layout.snapshots) > layout.snapshot_size:
+            layout.snapshots.popitem(last=False)
+
+    @staticmethod
+    def capture(controls):
+        """
+        Returns the actuals, the values sent to the client and the active with contexts of the controls.
+        """
+        return [
+            (
+                control,
+                tuple(control._anchors.actuals[attribute] for attribute in Actuals.__slots__),
+                tuple(control._get_attr(attribute) for attribute in Actuals.__slots__),
+                control._anchors.active_contexts,
+            )
+            for control in controls
+        ]
+
+    @staticmethod
+    def restore(layout, captured, stats=None):
+        """
+        Puts back the state returned by capture, flagging the controls whose values change to be sent.
+        """
+        for control, actuals, values, active_contexts in captured:
+            manager = control._anchors
+            manager.actuals.update(**dict(zip(Actuals.__slots__, actuals)))
+            manager.active_contexts = active_contexts
+            if manager._condition_index is not None:
+                manager._condition_index.regions = None  # Regions of the last solve, not of the restored one
+            if manager.linear is not None:
+                manager.linear.values = None
+            manager.memo.clear()
+            for attribute, value in zip(Actuals.__slots__, values):
+                if control._get_attr(attribute) != value:
+                    control._set_attr(attribute, value)
+                    layout.updated_controls[manager.id] = control
+                    if stats:
+                        stats.set_attrs += 1
+            if isinstance(control, AnchorGrid):
+                control._cells = None
+
+    @staticmethod
+    def restore_snapshot(layout, stats=None):
+        """
+        Handles the queued tasks from a stored snapshot if they only resize the root to a size seen before, returns
+        True if it did. Any other change invalidates all snapshots.
+        """
+        root = None
+        for task in layout.tasks:
+            manager = task.get("resize", (None,))[0]
+            if manager is None:
+                layout.snapshots.clear()
+                layout.snapshot_key = None
+                layout.snapshot_conditions = None
+                return False
+            if manager.parent is None:
+                root = manager
+        if root is None:
+            return False  # Client reporting sizes within the tree, stored with the current key after the pass
+
+        _, width, height = next(task["resize"] for task in reversed(layout.tasks) if task["resize"][0] is root)
+        previous = root.actuals.width, root.actuals.height
+        root.actuals.width, root.actuals.height = width, height
+        root.memo.clear()  # The conditions in the key are evaluated for the new size
+        key = AnchorManager.snapshot_key(layout, root)
+        layout.snapshot_root = root
+        layout.snapshot_key = key
+        snapshot = layout.snapshots.get(key)
+        root.actuals.width, root.actuals.height = previous
+        root.memo.clear()
+        if snapshot is None or any(task["resize"][0] is not root for task in layout.tasks):
+            return False
+
+        layout.snapshots.move_to_end(key)
+        layout.tasks.clear()
+        root.actuals.width, root.actuals.height = width, height
+        AnchorManager.restore(layout, snapshot, stats)
+        if stats:
+            stats.snapshot_hits += 1
+            if stats.tracer is not None:
+                stats.tracer.trigger = "resize,snapshot"
+        return True
 
-            if self.managed.page:
-                self.managed.page.update()
+    @staticmethod
+    def run_plan(layout, stats=None):
+        """
+        Lays out the queued tasks with the generated LayoutPlan if they only resize the root, returns True if it did.
+        Any other task drops the plan.
+        """
+        root = None
+        nested = False
+        for task in layout.tasks:
+            manager = task.get("resize", (None,))[0]
+            if manager is None:
+                layout.plan = None
+                return False
+            if manager.parent is None:
+                root = manager
+            else:
+                nested = True
+        if root is None or nested:
+            return False  # Client reporting sizes within the tree, the usual solve finds what they affect
+
+        if layout.plan is None:
+            layout.plan = LayoutPlan.create(root) or False
+        if not layout.plan or layout.plan.root is not root:
+            return False
+
+        _, width, height = layout.tasks[-1]["resize"]
+        layout.tasks.clear()
+        start = stats and time.perf_counter()
+        nodes = layout.plan.run(width, height, layout, stats)
+        if stats:
+            stats.compiled_passes += 1
+            stats.queue_depth += 1
+            stats.resolves += nodes
+            stats.solve_duration += time.perf_counter() - start
+            if stats.tracer is not None:
+                stats.tracer.trigger = "resize"
+                stats.tracer.add("compiled layout", "solve", start)
+        return True
 
-    def update_anchor_actuals(self):
-        self.update_anchors(self.anchors)
+    @staticmethod
+    def updates_by_page(layout, stats=None):
+        by_page = {}
+        for control in layout.updated_controls.values():
+            if control.page:
+                by_page.setdefault(control.page, []).append(control)
+        layout.updated_controls.clear()
+        if stats:
+            stats.page_updates += len(by_page)
+        return by_page
 
-        self.check_conditions()
+    @staticmethod
+    def send_updates(layout, stats=None):
+        for page, controls in AnchorManager.updates_by_page(layout, stats).items():
+            started = stats and stats.tracer and time.perf_counter()
+            page.update(*controls)
+            if started:
+                stats.tracer.add("page update", "update", started)
 
+    @staticmethod
+    async def send_updates_async(layout, stats=None):
+        for page, controls in AnchorManager.updates_by_page(layout, stats).items():
+            started = stats and stats.tracer and time.perf_counter()
+            await page.update_async(*controls)
+            if started:
+                stats.tracer.add("page update", "update", started)
+
+    def nodes(self):
+        if self._nodes is None:
+            present = {attribute for attribute, anchor in self.anchors.items() if anchor is not None}
+            for anchors in self.conditional_anchors.values():
+                present.update(attribute for attribute, anchor in anchors.items() if anchor is not None)
+            self._nodes = [attribute for attribute in self.ATTRIBUTE_ORDER if attribute in present]
+        return self._nodes
+
+    def dependencies(self, attribute):
+        """
+        Returns the (manager, axis) pairs that the value of the attribute is calculated from.
+        """
+        dependencies = self._dependencies.get(attribute)
+        if dependencies is None:
+            dependencies = {}
+            sources = list(Anchor.sources(self.anchors.get(attribute)))
+            for anchors in self.conditional_anchors.values():
+                if attribute in anchors:
+                    sources.extend(Anchor.sources(anchors[attribute]))
+            for control, source_attribute in sources:
+                manager = control._anchors
+                axis = self.AXIS[source_attribute]
+                if manager is not self or axis != self.AXIS[attribute]:
+                    dependencies[(manager.id, axis)] = manager
+            self._dependencies[attribute] = dependencies
+
+        if self.parent is not None:
+            return {**dependencies, (self.parent._anchors.id, self.AXIS[attribute]): self.parent._anchors}
+        return dependencies
+
+    def downstream(self, axis, attribute=None):
+        """
+        Returns the nodes, as (manager, attribute) pairs, that need to be recalculated when actuals on the axis change.
+        """
+        center = self.CENTERS[axis]
+        if center != attribute and center in self.nodes():
+            yield self, center
+
+        key = (self.id, axis)
+        for control in self.source_for.values():
+            dependent = control._anchors
+            for dependent_attribute in dependent.nodes():
+                if key in dependent.dependencies(dependent_attribute):
+                    yield dependent, dependent_attribute
+
+    def condition_dependents(self, axis):
+        """
+        Returns the managers with with-block conditions that watch actuals on the axis.
+        """
+        key = (self.id, axis)
         for control in self.source_for.values():
-            control._anchors.update_anchor_actuals()
+            dependent = control._anchors
+            if dependent.conditions and key in dependent.condition_index().dependencies:
+                yield dependent
+
+    def condition_index(self):
+        if self._condition_index is None:
+            self._condition_index = ConditionIndex(self.conditions)
+        return self._condition_index
+
+    def mark_dirty(self, to_update, stats=None):
+        """
+        Flags all nodes of this manager, and everything directly depending on its actuals, to be recalculated.
+        """
+        self.dirty.update(self.nodes())
+        to_update[self.id] = self
+        if isinstance(self.managed, AnchorGrid):
+            self.managed._arrange(to_update, stats)
+        for axis in (X, Y):
+            for manager, attribute in self.downstream(axis):
+                manager.dirty.add(attribute)
+                to_update[manager.id] = manager
+            for manager in self.condition_dependents(axis):
+                manager.conditions_dirty = True
+                to_update[manager.id] = manager
+
+    @staticmethod
+    def solve(layout, managers, stats=None):
+        """
+        Recalculates dirty nodes and everything downstream from them, each node at most once and in dependency order.
+        """
+        start = stats and time.perf_counter()
+        tracer = stats and stats.tracer
+        for _ in range(AnchorManager.MAX_PREDICTION_ROUNDS):
+            layout.generation = next(LayoutQueue.GENERATIONS)
+            stacks = {}  # Manager id: (manager, size before this round) for the nested stacks visited
+            for manager, attribute in AnchorManager.topological_order(managers):
+                if manager.conditions_dirty:
+                    manager.conditions_dirty = False
+                    if tracer:
+                        started = time.perf_counter()
+                    manager.refresh_conditions(stats)
+                    if tracer:
+                        tracer.add("conditions", "conditions", started, manager)
+                if attribute not in manager.dirty:
+                    continue
+                manager.dirty.discard(attribute)
+                if manager.id not in stacks and isinstance(manager.managed, AnchorStack):
+                    stacks[manager.id] = manager, (manager.actuals.width, manager.actuals.height)
+                if tracer:
+                    started = time.perf_counter()
+                axes = manager.update_node(attribute, stats)
+                if tracer:
+                    tracer.add(f"{tracer.label(manager)}.{attribute}", "resolve", started, manager, attribute)
+                for axis in axes:
+                    for dependent, dependent_attribute in manager.downstream(axis, attribute):
+                        dependent.dirty.add(dependent_attribute)
+                    for dependent in manager.condition_dependents(axis):
+                        dependent.conditions_dirty = True
+
+            # Lay out the contents of nested stacks whose size is now known, in this pass instead of after the client
+            # reports the size
+            managers = {}
+            for manager, size in stacks.values():
+                predicted = manager.predict_size()
+                if (manager.actuals.width, manager.actuals.height) != size and (
+                    predicted or isinstance(manager.managed, AnchorGrid)
+                ):
+                    manager.mark_dirty(managers, stats)
+            if not managers:
+                break
+        if stats:
+            stats.solve_duration += time.perf_counter() - start
+            if tracer:
+                tracer.add("solve", "solve", start)
+
+    @staticmethod
+    def topological_order(managers):
+        nodes = {}
+        edges = {}
+        to_visit = [
+            (manager, attribute)
+            for manager in managers.values()
+            for attribute in (manager.nodes() if manager.conditions_dirty else manager.dirty)
+        ]
+        while to_visit:
+            manager, attribute = to_visit.pop()
+            key = (manager.id, attribute)
+            if key in nodes:
+                continue
+            nodes[key] = manager, attribute
+            axis = manager.AXIS[attribute]
+            edges[key] = list(manager.downstream(axis, attribute))
+            for dependent in manager.condition_dependents(axis):
+                edges[key].extend((dependent, dependent_attribute) for dependent_attribute in dependent.nodes())
+            to_visit.extend(edges[key])
+
+        incoming = dict.fromkeys(nodes, 0)
+        for targets in edges.values():
+            for manager, attribute in targets:
+                incoming[(manager.id, attribute)] += 1
+
+        ready = [key for key, count in incoming.items() if count == 0]
+        while nodes:
+            if not ready:  # Cycle, break it at an arbitrary node
+                ready = [next(iter(nodes))]
+            key = ready.pop()
+            if key not in nodes:
+                continue
+            yield nodes.pop(key)
+            for manager, attribute in edges[key]:
+                target_key = (manager.id, attribute)
+                incoming[target_key] -= 1
+                if incoming[target_key] == 0:
+                    ready.append(target_key)
+
+    def predict_size(self):
+        """
+        Sets the size of a nested stack from its position when anchors fix both of its edges on an axis, like the client
+        would report it. Returns True if the size changed.
+        """
+        if not self.is_laid_out():
+            return False
+        parent_actuals = self.parent._anchors.actuals
+        changed = False
+        for leading, trailing, size in ((LEFT, RIGHT, WIDTH), (TOP, BOTTOM, HEIGHT)):
+            if self.is_anchored(size) or not (self.is_anchored(leading) and self.is_anchored(trailing)):
+                continue
+            start, end, total = self.actuals[leading], self.actuals[trailing], parent_actuals[size]
+            if start is None or end is None or total is None:
+                continue
+            if self.actuals[size] != total - start - end:
+                self.actuals[size] = total - start - end
+                self.memo.clear()
+                changed = True
+        return changed
+
+    def is_anchored(self, attribute):
+        if self.anchors.get(attribute) is not None:
+            return True
+        return any(
+            self.conditional_anchors[context_id].get(attribute) is not None for context_id in self.active_contexts
+        )
+
+    def is_laid_out(self):
+        return self.parent is not None and (self.managed.page or self.layout.headless)
+
+    def refresh_conditions(self, stats=None):
+        """
+        Updates the active with contexts, flagging the attributes of the contexts that turned on or off.
+        """
+        if not self.is_laid_out():
+            return
+
+        active = self.check_conditions(stats)
+        if wake_at := self.condition_index().wake_at:
+            self.schedule_condition_check(wake_at - time.monotonic())
+        if active != self.active_contexts:
+            for context_id in set(active).symmetric_difference(self.active_contexts):
+                self.dirty.update(
+                    attribute for attribute, anchor in self.conditional_anchors[context_id].items()
+                    if anchor is not None
+                )
+            self.active_contexts = active
+
+    def schedule_condition_check(self, delay):
+        if self.condition_timer is not None:
+            self.condition_timer.cancel()
+        self.condition_timer = threading.Timer(max(delay, 0), self.recheck_conditions)
+        self.condition_timer.daemon = True
+        self.condition_timer.start()
+
+    def recheck_conditions(self):
+        self.condition_timer = None
+        self.layout.tasks.append({"conditions": self})
+        self.process_queue()
+
+    def update_node(self, attribute, stats=None):
+        """
+        Sets the actuals for one attribute from the active anchor, returns the axes where actuals changed.
+        """
+        if not self.is_laid_out():
+            return ()
+        if self.parent._anchors.linear is not None:
+            return self.parent._anchors.linear.update(self, stats)
+
+        candidates = [self.anchors.get(attribute)]
+        for context_id in self.active_contexts:
+            candidates.append(self.conditional_anchors[context_id].get(attribute))
 
-    def update_anchors(self, anchors):
-        for attribute, anchor in anchors.items():
+        for anchor in reversed(candidates):
             if anchor is None:
                 continue
-            # print (self.managed.content, attribute, anchor)
             if type(anchor) is not Anchor:
                 source_value = anchor
             else:
                 target_data = Anchor.TargetData(self.managed, attribute, self.parent)
-                source_value = anchor._resolve(target_data)
+                source_value = anchor.compile(attribute)(target_data)
+                if stats:
+                    stats.resolves += 1
                 if source_value is None:
                     continue
+            return self.update_actuals(attribute, source_value, stats)
+
+        return ()
+
+    def update_actuals(self, attribute, source_value, stats=None):
+        setter = self.SETTERS[attribute]
+        set_value = setter(source_value, self.anchors, self.actuals, self.parent._anchors.actuals)
+
+        changed = set()
+        for set_attribute, final_value in set_value.items():
+            if self.actuals.get(set_attribute) != final_value:
+                self.actuals[set_attribute] = final_value
+                self.memo.clear()
+                self.managed._set_attr(set_attribute, final_value)
+                self.layout.updated_controls[self.id] = self.managed
+                changed.add(self.AXIS[set_attribute])
+                if stats:
+                    stats.set_attrs += 1
+        return changed
+
+    def source_value(self, attribute, for_child):
+        """
+        Value of the attribute as seen by a control in this stack (for_child) or by a peer, memoized for the current
+        layout pass so that it is calculated only once however many anchors depend on it.
+        """
+        generation = self.layout.generation
+        if self.memo_generation != generation:
+            self.memo.clear()
+            self.memo_generation = generation
+
+        key = attribute, for_child
+        value = self.memo.get(key)
+        if value is None:
+            if for_child or self.parent is None:  # A root stack fills the page
+                value = Anchor.GETTERS_PARENT[attribute](self.actuals)
+            else:
+                value = Anchor.GETTERS_PEER[attribute](self.actuals, self.parent._anchors.actuals)
+            self.memo[key] = value
+        return value
+
+    def descendants(self):
+        for control in getattr(self.managed, "controls", ()):
+            if isinstance(control, Anchored):
+                yield control
+                yield from control._anchors.descendants()
+
+    def solve_headless(self, width, height, measure=None):
+        """
+        Runs the layout as if the client had reported the given size for the managed stack, then keeps feeding the
+        resulting control sizes back in, like the client would with resize events, until they no longer change.
+        The live tree is left as it was, so this can be used while the stack is on a page.
+        """
+        layout = self.layout
+        with layout.lock:
+            layout.headless += 1
+            captured = None
+            try:
+                self.process_queue()
+                stats = layout.start_pass()
+                if stats and stats.tracer is not None:
+                    stats.tracer.trigger = "headless"
+                controls = list(self.descendants())
+                captured = self.capture((self.managed, *controls))
+                updated_controls = dict(layout.updated_controls)
+
+                self.actuals["width"] = width
+                self.actuals["height"] = height
+                if not self.solve_compiled(layout, width, height, stats):
+                    to_update = {}
+                    self.mark_dirty(to_update)
+                    for control in controls:
+                        control._anchors.mark_dirty(to_update)
+                    self.solve(layout, to_update, stats)
+
+                for _ in range(self.MAX_HEADLESS_ROUNDS):
+                    to_update = {}
+                    for control in controls:
+                        box = self.box(control, measure)
+                        manager = control._anchors
+                        size = box["width"], box["height"]
+                        if (manager.actuals.get("width"), manager.actuals.get("height")) != size:
+                            manager.actuals["width"] = box["width"]
+                            manager.actuals["height"] = box["height"]
+                            manager.mark_dirty(to_update, stats)
+                    if not to_update:
+                        break
+                    self.solve(layout, to_update, stats)
+
+                layout.finish_pass(stats)
+                return {control: self.box(control, measure) for control in controls}
+            finally:
+                if captured is not None:
+                    self.restore(layout, captured)
+                    layout.updated_controls.clear()
+                    layout.updated_controls.update(updated_controls)
+                layout.headless -= 1
+
+    def solve_compiled(self, layout, width, height, stats=None):
+        """
+        Lays out a root stack with its LayoutPlan if compiled layout is enabled, returns True if it did.
+        """
+        if not layout.compiled or self.parent is not None:
+            return False
+        layout.tasks.append({"resize": (self, width, height)})
+        if self.run_plan(layout, stats):
+            return True
+        layout.tasks.clear()
+        return False
+
+    @staticmethod
+    def box(control, measure=None):
+        """
+        Returns the position and size the client would give the control, based on the values sent to it.
+        """
+        values = {}
+        for attribute in (LEFT, RIGHT, TOP, BOTTOM, WIDTH, HEIGHT):
+            value = control._get_attr(attribute)
+            values[attribute] = None if value in (None, "") else value
+        parent_actuals = control._anchors.parent._anchors.actuals
+        measured = None
+
+        box = {}
+        for index, (leading, trailing, size) in enumerate(((LEFT, RIGHT, WIDTH), (TOP, BOTTOM, HEIGHT))):
+            total = parent_actuals.get(size, 0)
+            start, end, length = values[leading], values[trailing], values[size]
+            if start is not None and end is not None:
+                length = total - start - end
+            elif length is None:
+                if measured is None:
+                    measured = measure(control) if measure else (0, 0)
+                length = measured[index]
+            if start is None:
+                start = total - end - length if end is not None else 0
+            box[leading] = start
+            box[size] = length
+        return box
+
+    def check_conditions(self, stats=None):
+        """
+        Returns the ids of the with contexts whose conditions currently hold.
+        """
+        target = Anchor.TargetData(self.managed, TOP, self.parent)  # Dummy attribute
+        return self.condition_index().active_contexts(target, self.active_contexts, stats)
 
-            setter = self.SETTERS[attribute]
-            set_value = setter(source_value, self.anchors, self.actuals, self.parent._anchors.actuals)
 
-            for set_attribute, final_value in set_value.items():
-                if self.actuals.get(set_attribute) != final_value:
-                    self.actuals[set_attribute] = final_value
-                    self.managed._set_attr(set_attribute, final_value)
+class LinearLayout:
+    """
+    Lays out the controls in a stack by solving all their anchors together as weighted linear constraints with
+    kiwisolver, an incremental Cassowary simplex solver, instead of evaluating them one at a time.
+
+    Anchors, modifiers with constants, share() and min/max become strong constraints in the coordinates of the stack,
+    min/max with the help of weak constraints that pull the result to the extremes. With-block and & | conditions are
+    evaluated as usual to pick the anchors in use. The stack size and values from controls outside the stack are edit
+    variables, so a resize is one incremental re-solve. The constraints are rebuilt only when the anchors in use
+    change.
+    """
 
-    def check_conditions(self):
-        target = Anchor.TargetData(self.managed, TOP, self.parent)  # Dummy attribute
-        for context_id, conditions in self.conditions.items():
-            if all(
-                Anchor._resolve_recursively(condition, target)
-                for condition_list in conditions for condition in condition_list
+    EDIT = kiwisolver and kiwisolver.strength.create(999, 0, 0)  # Inputs, stronger than any anchor
+    ANCHOR = kiwisolver and kiwisolver.strength.strong
+    PREFERENCE = kiwisolver and kiwisolver.strength.weak
+
+    def __init__(self, stack):
+        self.stack = stack
+        self.solver = None
+        self.signature = None
+        self.variables = {}  # Manager id: (left, top, width, height) variables
+        self.inputs = []  # (variable, function returning its value)
+        self.stays = []  # (variable, manager, attribute) keeping controls where they are unless anchors move them
+        self.values = None
+        self.size = {}  # Stack width and height variables
+        self.external = {}  # (manager id, attribute): variable for a value from outside the stack
+        self.written = {}  # Manager id: (manager, axes and sizes that the solution is written to)
+        self.changed = {}  # Manager id: axes changed by a solve, until the manager is updated
+        self.generation = None  # Layout round of the last solve
+        self.contexts = {}  # Manager id: active with contexts that the last solve saw
+
+    def update(self, manager, stats=None):
+        """
+        Solves the stack once per layout round, returns the axes where the actuals of the manager changed.
+        Later in the round, only values from outside the stack are checked again, as the nodes they come from may be
+        ordered after the first control of the stack.
+        """
+        generation = manager.layout.generation
+        if generation != self.generation or manager.active_contexts != self.contexts.get(manager.id):
+            self.generation = generation
+            self.changed.update(self.solve(stats))
+        else:
+            self.changed.update(self.resolve(stats))
+        if manager.id in self.changed:
+            return self.changed.pop(manager.id)
+        return self.write_solution(manager, stats)  # In case the client reported something else
+
+    def solve(self, stats=None):
+        managers = [control._anchors for control in self.stack.content.controls if isinstance(control, Anchored)]
+        for manager in managers:  # Conditions of all the controls, not only the ones already visited in this pass
+            manager.refresh_conditions(stats)
+        anchors_in_use = {manager.id: self.anchors_in_use(manager) for manager in managers}
+        signature = (
+            self.stack.padding,
+            tuple(
+                (manager.id, manager.managed.gap, tuple(
+                    (attribute, Anchor.structure_key(value)) for attribute, value in anchors_in_use[manager.id].items()
+                ))
+                for manager in managers
+            ),
+        )
+        if signature != self.signature:
+            self.build(managers, anchors_in_use)
+            self.signature = signature
+            self.values = None
+        self.contexts = {manager.id: manager.active_contexts for manager in managers}
+        return self.resolve(stats)
+
+    def resolve(self, stats=None):
+        """
+        Re-solves with the current input values, if they changed, returns the axes changed by manager id.
+        """
+        values = tuple(value() for _, value in self.inputs)
+        if values == self.values:
+            return {}
+        self.values = values
+        for (variable, _), value in zip(self.inputs, values):
+            self.solver.suggestValue(variable, value)
+        for variable, manager, attribute in self.stays:
+            self.solver.suggestValue(variable, manager.actuals.get(attribute, 0))
+        self.solver.updateVariables()
+        if stats:
+            stats.resolves += 1
+
+        changed = {}
+        for manager, _ in self.written.values():
+            axes = self.write_solution(manager, stats)
+            if axes:
+                changed[manager.id] = axes
+        return changed
+
+    def write_solution(self, manager, stats=None):
+        if manager.id not in self.written:
+            return ()
+        write_x, write_width, write_y, write_height = self.written[manager.id][1]
+        left, top, width, height = (variable.value() for variable in self.variables[manager.id])
+        solved = {}
+        if write_x:
+            solved.update(left=left, right=None)
+            if write_width:
+                solved["width"] = width
+        if write_y:
+            solved.update(top=top, bottom=None)
+            if write_height:
+                solved["height"] = height
+
+        axes = set()
+        for attribute, value in solved.items():
+            if manager.actuals[attribute] != value:
+                manager.actuals[attribute] = value
+                manager.memo.clear()
+                manager.managed._set_attr(attribute, value)
+                manager.layout.updated_controls[manager.id] = manager.managed
+                axes.add(AnchorManager.AXIS[attribute])
+                if stats:
+                    stats.set_attrs += 1
+        return axes
+
+    @staticmethod
+    def anchors_in_use(manager):
+        """
+        Returns attribute: anchor or constant, as update_node would choose them, with & | conditions evaluated.
+        """
+        anchors = {}
+        for attribute in manager.nodes():
+            candidates = [manager.anchors.get(attribute)]
+            for context_id in manager.active_contexts:
+                candidates.append(manager.conditional_anchors[context_id].get(attribute))
+            target = Anchor.TargetData(manager.managed, attribute, manager.parent)
+            for anchor in reversed(candidates):
+                anchor = LinearLayout.choose(anchor, target)
+                if anchor is not None:
+                    anchors[attribute] = anchor
+                    break
+        return anchors
+
+    @staticmethod
+    def choose(anchor, target):
+        while type(anchor) is Anchor and anchor._real_conditions:
+            checks = anchor._conditions[0]._conditions
+            if all(Anchor.compile_value(condition, target.attribute)(target) for condition in checks):
+                anchor = anchor._derive(_conditions=(), _real_conditions=False, _alternative=None)
+            else:
+                anchor = anchor._alternative
+        return anchor
+
+    def build(self, managers, anchors_in_use):
+        self.solver = kiwisolver.Solver()
+        self.inputs = []
+        self.stays = []
+        self.written = {}
+        self.variables = {
+            manager.id: tuple(
+                kiwisolver.Variable(f"{manager.id}.{attribute}") for attribute in (LEFT, TOP, WIDTH, HEIGHT)
+            )
+            for manager in managers
+        }
+        self.size = {}
+        self.external = {}
+        stack = self.stack._anchors
+        for attribute in (WIDTH, HEIGHT):
+            self.size[attribute] = self.add_input(
+                kiwisolver.Variable(f"stack.{attribute}"), lambda attribute=attribute: stack.actuals.get(attribute, 0)
+            )
+
+        for manager in managers:
+            anchors = anchors_in_use[manager.id]
+            axes = []
+            for axis, (position, size) in ((X, (LEFT, WIDTH)), (Y, (TOP, HEIGHT))):
+                anchored = [attribute for attribute in anchors if AnchorManager.AXIS[attribute] == axis]
+                fixes_size = size in anchored or len(anchored) > 1
+                axes.extend((bool(anchored), fixes_size))
+                variable = self.variables[manager.id][1 if axis == Y else 0]
+                size_variable = self.variables[manager.id][3 if axis == Y else 2]
+                self.solver.addEditVariable(variable, self.PREFERENCE)
+                self.stays.append((variable, manager, position))
+                self.solver.addEditVariable(size_variable, self.PREFERENCE)
+                if fixes_size:
+                    self.stays.append((size_variable, manager, size))
+                else:  # Size comes from the client
+                    self.inputs.append((size_variable, lambda manager=manager, size=size: manager.actuals.get(size, 0)))
+            if any(axes[::2]):
+                self.written[manager.id] = manager, tuple(axes)
+
+            for attribute, anchor in anchors.items():
+                target = self.target_expression(manager, attribute)
+                self.solver.addConstraint((target == self.expression(anchor, manager, attribute)) | self.ANCHOR)
+
+    def add_input(self, variable, value):
+        self.solver.addEditVariable(variable, self.EDIT)
+        self.inputs.append((variable, value))
+        return variable
+
+    def target_expression(self, manager, attribute):
+        left, top, width, height = self.variables[manager.id]
+        return {
+            LEFT: left, RIGHT: left + width, WIDTH: width, CENTER_X: left + width / 2,
+            TOP: top, BOTTOM: top + height, HEIGHT: height, CENTER_Y: top + height / 2,
+        }[attribute]
+
+    def source_expression(self, control, attribute, manager, target_attribute):
+        source = control._anchors
+        source_type = Anchor.ATTRIBUTE_TYPES[attribute]
+        target_type = Anchor.ATTRIBUTE_TYPES[target_attribute]
+        if control is self.stack:
+            width, height = self.size[WIDTH], self.size[HEIGHT]
+            value = {
+                LEFT: 0, RIGHT: width, WIDTH: width, CENTER_X: width / 2,
+                TOP: 0, BOTTOM: height, HEIGHT: height, CENTER_Y: height / 2,
+            }[attribute]
+            if source_type == target_type == Anchor.LEADING:
+                value = value + self.stack.padding
+            elif source_type == target_type == Anchor.TRAILING:
+                value = value - self.stack.padding
+            return value
+
+        if source.id in self.variables:
+            value = self.target_expression(source, attribute)
+        else:  # Outside the stack, an input like the stack size
+            key = source.id, attribute
+            if key not in self.external:
+                self.external[key] = self.add_input(
+                    kiwisolver.Variable(f"{source.id}.{attribute}"),
+                    lambda: source.source_value(attribute, False),
+                )
+            value = self.external[key]
+        if source_type == Anchor.LEADING and target_type == Anchor.TRAILING:
+            value = value - manager.managed.gap
+        elif source_type == Anchor.TRAILING and target_type == Anchor.LEADING:
+            value = value + manager.managed.gap
+        return value
+
+    def expression(self, value, manager, attribute):
+        """
+        Returns the anchor as a linear expression, adding helper constraints for min and max.
+        """
+        if type(value) is dict:
+            return self.apply(
+                value["op"],
+                self.expression(value["left"], manager, attribute),
+                self.expression(value["right"], manager, attribute),
+            )
+        if type(value) is not Anchor:
+            return value
+        if value._real_conditions:
+            raise ValueError("The linear engine only supports & | conditions on whole anchors")
+
+        if value._max_of or value._min_of:
+            extreme = "max" if value._max_of else "min"
+            result = kiwisolver.Variable(f"{manager.id}.{attribute}.{extreme}")
+            for part in value._max_of or value._min_of:
+                part = self.expression(part, manager, attribute)
+                bound = result >= part if extreme == "max" else result <= part
+                self.solver.addConstraint(bound | self.ANCHOR)
+                self.solver.addConstraint((result == part) | self.PREFERENCE)
+            result = self.modify(value._modifiers, result, manager, attribute)
+        elif value._control == "constant":
+            result = value._attribute
+        else:
+            result = self.source_expression(value._control, value._attribute, manager, attribute)
+            result = self.modify(value._modifiers, result, manager, attribute)
+
+        if value._share is not None:
+            share_of, total = value._share
+            gap = manager.managed.gap
+            padding = self.stack.padding
+            result = ((result - (total - 1) * gap - 2 * padding) / total) * share_of + (share_of - 1) * gap
+        return result
+
+    def modify(self, modifiers, source, manager, attribute):
+        if modifiers is None or modifiers is Anchor.SOURCE_VALUE:
+            return source
+        left = self.modify(modifiers["left"], source, manager, attribute)
+        return self.apply(modifiers["op"], left, self.expression(modifiers["right"], manager, attribute))
+
+    @staticmethod
+    def apply(op, left, right):
+        if op not in (operator.add, operator.sub, operator.mul, operator.truediv):
+            raise ValueError(f"The linear engine does not support {op.__name__} in anchors")
+        try:
+            return op(left, right)
+        except TypeError:
+            raise ValueError("The linear engine only supports anchors that are linear") from None
+
+
+class LayoutPlan:
+    """
+    The layout of a whole root stack as one generated Python function of the root size. Every anchored attribute
+    becomes a few lines of arithmetic on local variables, in dependency order, and every with context an if, so a
+    resize runs straight through without looking up anchors, setters or getters.
+
+    Used for passes that only resize the root, and generated again on the next resize after anything else changes.
+    Trees with the linear engine, virtual grids, hysteresis conditions, controls that are not on a page, or anchors
+    that depend on each other in a cycle are laid out as usual.
+    """
+
+    OPERATORS = {
+        operator.add: "+", operator.sub: "-", operator.mul: "*", operator.truediv: "/", operator.floordiv: "//",
+        operator.mod: "%", operator.pow: "**", operator.lt: "<", operator.le: "<=", operator.gt: ">",
+        operator.ge: ">=", operator.eq: "==", operator.ne: "!=",
+    }
+    SIZES = {X: (LEFT, RIGHT, WIDTH), Y: (TOP, BOTTOM, HEIGHT)}
+
+    def __init__(self, root):
+        self.root = root
+        self.namespace = {}
+        self.inputs = {}  # Local variable name: (manager, attribute) whose actual value it starts from
+        self.outputs = {}  # (manager, attribute): True if the value is also sent to the client
+        self.contexts = []  # Managers whose active with contexts the function returns
+        self.grids = []
+        self.node_count = 0
+        self.temporaries = 0
+        self.shared = {}  # Source of a common expression: the local variable with its value
+        self.flags = {}  # Manager id: local variables telling if each of its with contexts is active
+        self.source = self.generate()
+        exec(compile(self.source, f"<layout plan of {root.id}>", "exec"), self.namespace)
+        self.function = self.namespace["layout"]
+        self.outputs = list(self.outputs.items())
+
+    @classmethod
+    def create(cls, root):
+        """
+        Returns the plan for the root manager, or None if the tree cannot be compiled.
+        """
+        try:
+            return cls(root)
+        except ValueError:
+            return None
+
+    def run(self, width, height, layout, stats=None):
+        """
+        Lays out the tree for the root size and applies the changed values, returns the number of nodes evaluated.
+        """
+        grids = [(grid, grid.actuals.width, grid.actuals.height) for grid in self.grids]
+        values, contexts = self.function(width, height)
+
+        root = self.root
+        root.actuals.width, root.actuals.height = width, height
+        layout.generation = next(LayoutQueue.GENERATIONS)
+        for ((manager, attribute), send), value in zip(self.outputs, values):
+            actuals = manager.actuals
+            if actuals[attribute] != value:
+                actuals[attribute] = value
+                if send:
+                    manager.managed._set_attr(attribute, value)
+                    layout.updated_controls[manager.id] = manager.managed
+                    if stats:
+                        stats.set_attrs += 1
+        for manager, active in zip(self.contexts, contexts):
+            manager.active_contexts = active
+            manager.condition_index().regions = None  # Regions of the last solve, not of this one
+
+        to_update = {}
+        for grid, grid_width, grid_height in grids:
+            if (grid.actuals.width, grid.actuals.height) != (grid_width, grid_height):
+                grid.managed._arrange(to_update, stats)
+        if to_update:
+            AnchorManager.solve(layout, to_update, stats)
+        return self.node_count
+
+    def generate(self):
+        managers = [control._anchors for control in self.root.descendants()]
+        if self.root.linear is not None:
+            raise ValueError("The linear engine solves its own stack")
+        for manager in managers:
+            if isinstance(manager.managed, AnchorVirtualGrid) or manager.linear is not None:
+                raise ValueError("Virtual grids and the linear engine are laid out as usual")
+            if manager.conditions and manager.condition_index().stateful:
+                raise ValueError("Hysteresis conditions depend on earlier values")
+            if not manager.is_laid_out():
+                raise ValueError("Only trees that are on a page")
+        self.grids = [manager for manager in (self.root, *managers) if isinstance(manager.managed, AnchorGrid)]
+
+        steps = {}  # Key: (kind, manager, attribute or axis), kinds "conditions", "node" and "size"
+        for manager in managers:
+            if manager.conditions:
+                steps[("conditions", manager.id)] = "conditions", manager, None
+            for attribute in manager.nodes():
+                steps[("node", manager.id, attribute)] = "node", manager, attribute
+            if isinstance(manager.managed, AnchorStack):
+                for axis, (leading, trailing, size) in self.SIZES.items():
+                    present = set(manager.nodes())
+                    if size not in present and leading in present and trailing in present:
+                        steps[("size", manager.id, axis)] = "size", manager, axis
+
+        lines = []
+        for kind, manager, attribute in self.order(steps):
+            lines.extend(getattr(self, f"{kind}_lines")(manager, attribute))
+        self.node_count = sum(1 for kind, _, _ in steps.values() if kind == "node")
+
+        root = self.root
+        prelude = [
+            f"{name} = a{manager.id}.{attribute}" for name, (manager, attribute) in self.inputs.items()
+            if manager is not root or attribute not in (WIDTH, HEIGHT)
+        ]
+        prelude.append(f"{self.variable(root, WIDTH)}, {self.variable(root, HEIGHT)} = width, height")
+        for manager, _ in self.inputs.values():
+            self.namespace[f"a{manager.id}"] = manager.actuals
+        values = "".join(f"{self.variable(manager, attribute)}, " for manager, attribute in self.outputs)
+        contexts = "".join(f"{active}, " for _, active in self.contexts)
+        self.contexts = [manager for manager, _ in self.contexts]
+        body = "\n".join(f"    {line}" for line in (*prelude, *lines, f"return ({values}), ({contexts})"))
+        return f"def layout(width, height):\n{body}\n"
+
+    def order(self, steps):
+        """
+        Returns the steps in dependency order, raising ValueError if they depend on each other in a cycle.
+        """
+        def on_axis(manager, axis):
+            nodes = [attribute for attribute in manager.nodes() if AnchorManager.AXIS[attribute] == axis]
+            return [*(("node", manager.id, attribute) for attribute in nodes), ("size", manager.id, axis)]
+
+        edges = {key: [] for key in steps}
+        for key, (kind, manager, attribute) in steps.items():
+            sources = []
+            if kind == "conditions":
+                for (_, axis), source in manager.condition_index().dependencies.items():
+                    sources.extend(on_axis(source, axis))
+            elif kind == "node":
+                for (_, axis), source in manager.dependencies(attribute).items():
+                    sources.extend(on_axis(source, axis))
+                axis = AnchorManager.AXIS[attribute]
+                if attribute == AnchorManager.CENTERS[axis]:
+                    sources.extend(on_axis(manager, axis))
+            else:
+                center = AnchorManager.CENTERS[attribute]
+                sources.extend(source for source in on_axis(manager, attribute) if source[2] != center)
+                sources.extend(on_axis(manager.parent._anchors, attribute))
+            if kind != "conditions" and manager.conditions:
+                sources.append(("conditions", manager.id))
+            for source in sources:
+                if source in steps and source != key:
+                    edges[source].append(key)
+
+        incoming = dict.fromkeys(steps, 0)
+        for targets in edges.values():
+            for target in targets:
+                incoming[target] += 1
+        ready = [key for key in reversed(steps) if incoming[key] == 0]
+        ordered = []
+        while ready:
+            key = ready.pop()
+            ordered.append(steps[key])
+            for target in edges[key]:
+                incoming[target] -= 1
+                if incoming[target] == 0:
+                    ready.append(target)
+        if len(ordered) < len(steps):
+            raise ValueError("Anchors that depend on each other in a cycle")
+        return ordered
+
+    def conditions_lines(self, manager, _):
+        """
+        Flags for the with contexts of the manager, and the list of the active ones. Controls in the same with block
+        usually share the conditions, and those are evaluated only once.
+        """
+        lines = []
+        flags = []
+        for index, condition_lists in enumerate(manager.conditions.values()):
+            checks = " and ".join(
+                self.expression(condition, manager, TOP)[0]
+                for condition_list in condition_lists for condition in condition_list
+            ) or "True"
+            if checks not in self.shared:
+                self.shared[checks] = f"c{manager.id}_{index}"
+                lines.append(f"c{manager.id}_{index} = {checks}")
+            flags.append(self.shared[checks])
+        self.flags[manager.id] = flags
+
+        pairs = "".join(
+            f"({self.literal(context_id)}, {flag}), " for context_id, flag in zip(manager.conditions, flags)
+        )
+        if pairs not in self.shared:
+            self.shared[pairs] = f"active{manager.id}"
+            lines.append(f"active{manager.id} = [context_id for context_id, active in ({pairs}) if active]")
+        self.contexts.append((manager, self.shared[pairs]))
+        return lines
+
+    def node_lines(self, manager, attribute):
+        candidates = [("True", manager.anchors.get(attribute))]
+        for flag, context_id in zip(self.flags.get(manager.id, ()), manager.conditions):
+            candidates.append((flag, manager.conditional_anchors[context_id].get(attribute)))
+        candidates = [
+            (flag, *self.expression(anchor, manager, attribute)) for flag, anchor in reversed(candidates)
+            if anchor is not None
+        ]
+        if not candidates:
+            return []
+
+        if len(candidates) == 1 and candidates[0][0] == "True" and not candidates[0][2]:
+            return [f"v = {candidates[0][1]}", *self.setter_lines(manager, attribute)]
+
+        lines = []
+        if any(may_be_none for _, _, may_be_none in candidates):  # Falls through to the next one, like update_node
+            lines.append("v = None")
+            for flag, code, _ in candidates:
+                lines.extend((f"if v is None and {flag}:", f"    v = {code}"))
+        else:
+            for index, (flag, code, _) in enumerate(candidates):
+                lines.extend(("else:" if flag == "True" else f"{'elif' if index else 'if'} {flag}:", f"    v = {code}"))
+            if candidates[-1][0] == "True":
+                return lines + self.setter_lines(manager, attribute)
+            lines.extend(("else:", "    v = None"))
+        lines.append("if v is not None:")
+        lines.extend(f"    {line}" for line in self.setter_lines(manager, attribute))
+        return lines
+
+    def setter_lines(self, manager, attribute):
+        """
+        Assignments that AnchorManager.SETTERS would make for the value v.
+        """
+        parent = manager.parent._anchors
+        if attribute in (LEFT, TOP, WIDTH, HEIGHT):
+            return [self.assign(manager, attribute, "v")]
+        if attribute == RIGHT:
+            return [self.assign(manager, RIGHT, f"{self.get(parent, WIDTH)} - v")]
+        if attribute == BOTTOM:
+            return [self.assign(manager, BOTTOM, f"{self.get(parent, HEIGHT)} - v")]
+        leading, trailing, size = self.SIZES[AnchorManager.AXIS[attribute]]
+        if manager.anchors.get(leading) is not None:  # Leading edge locked, size must give
+            return [self.assign(manager, size, f"2 * (v - {self.get(manager, leading)})")]
+        if manager.anchors.get(trailing) is not None:
+            return [self.assign(
+                manager, size, f"2 * ({self.get(parent, size)} - {self.get(manager, trailing)} - v)"
+            )]
+        return [self.assign(manager, leading, f"v - {self.get(manager, size)} / 2")]
+
+    def size_lines(self, manager, axis):
+        """
+        The size of a nested stack from its edges, like AnchorManager.predict_size.
+        """
+        leading, trailing, size = self.SIZES[axis]
+        start, end = self.variable(manager, leading), self.variable(manager, trailing)
+        total = self.variable(manager.parent._anchors, size)
+        self.outputs.setdefault((manager, size), False)
+        return [
+            f"if {self.anchored(manager, leading)} and {self.anchored(manager, trailing)} and {start} is not None"
+            f" and {end} is not None and {total} is not None:",
+            f"    {self.variable(manager, size)} = {total} - {start} - {end}",
+        ]
+
+    def anchored(self, manager, attribute):
+        """
+        Source of an expression that is true if the attribute has an anchor, like AnchorManager.is_anchored.
+        """
+        if manager.anchors.get(attribute) is not None:
+            return "True"
+        flags = [
+            flag for flag, context_id in zip(self.flags.get(manager.id, ()), manager.conditions)
+            if manager.conditional_anchors[context_id].get(attribute) is not None
+        ]
+        return f"({' or '.join(flags)})" if flags else "False"
+
+    def assign(self, manager, attribute, code):
+        self.outputs[(manager, attribute)] = True
+        return f"{self.variable(manager, attribute)} = {code}"
+
+    def variable(self, manager, attribute):
+        name = f"m{manager.id}_{attribute}"
+        self.inputs.setdefault(name, (manager, attribute))
+        return name
+
+    def get(self, manager, attribute):
+        """
+        The actual value with 0 for None, like Actuals.get(attribute, 0).
+        """
+        name = self.variable(manager, attribute)
+        if manager is self.root and attribute in (WIDTH, HEIGHT):  # Arguments of the function
+            return name
+        return f"({name} if {name} is not None else 0)"
+
+    def literal(self, value):
+        if type(value) in (int, float, bool, str) and repr(value) not in ("inf", "-inf", "nan") or value is None:
+            return repr(value)
+        key = "constant", Anchor.structure_key(value)
+        if key not in self.shared:
+            self.shared[key] = f"k{len(self.namespace)}"
+            self.namespace[self.shared[key]] = value
+        return self.shared[key]
+
+    def operation(self, op, left, right):
+        if op in self.OPERATORS:
+            return f"({left} {self.OPERATORS[op]} {right})"
+        return f"{self.literal(op)}({left}, {right})"
+
+    def expression(self, value, manager, attribute):
+        """
+        Returns the source of the value as Anchor.compile_value evaluates it, and whether it can be None.
+        """
+        if type(value) is dict:
+            return self.operation(
+                value["op"],
+                self.expression(value["left"], manager, attribute)[0],
+                self.expression(value["right"], manager, attribute)[0],
+            ), False
+        if type(value) is not Anchor:
+            return self.literal(value), value is None
+
+        may_be_none = False
+        if value._max_of or value._min_of:
+            parts = ", ".join(self.expression(part, manager, attribute)[0] for part in value._max_of or value._min_of)
+            code = self.modify(value._modifiers, f"{'max' if value._max_of else 'min'}({parts})", manager, attribute)
+        elif value._control == "constant":
+            code, may_be_none = self.literal(value._attribute), value._attribute is None
+        else:
+            code = self.source(value, manager, attribute)
+
+        if value._real_conditions:
+            checks = " and ".join(
+                self.expression(condition, manager, attribute)[0] for condition in value._conditions[0]._conditions
+            )
+            alternative, alternative_none = "None", True
+            if value._alternative is not None:
+                alternative, alternative_none = self.expression(value._alternative, manager, attribute)
+            code = f"({code} if {checks} else {alternative})"
+            may_be_none = may_be_none or alternative_none
+
+        if value._share is not None:
+            share_of, total = value._share
+            gap, padding = manager.managed.gap, manager.parent.padding
+            result = code
+            if may_be_none:
+                self.temporaries += 1
+                result = f"t{self.temporaries}"
+            shared = (
+                f"((({result} - {(total - 1) * gap!r} - {2 * padding!r}) / {total!r}) * {share_of!r}"
+                f" + {(share_of - 1) * gap!r})"
+            )
+            code = f"(None if ({result} := {code}) is None else {shared})" if may_be_none else shared
+        return code, may_be_none
+
+    def source(self, anchor, manager, attribute):
+        """
+        The referenced value with the padding or gap, and the modifiers, like Anchor._compile_one.
+        """
+        source_control = anchor._control
+        source = source_control._anchors
+        source_attribute = anchor._attribute
+        source_type = Anchor.ATTRIBUTE_TYPES[source_attribute]
+        target_type = Anchor.ATTRIBUTE_TYPES[attribute]
+
+        if manager.parent is source_control:
+            code = {
+                LEFT: "0", TOP: "0",
+                RIGHT: self.get(source, WIDTH), WIDTH: self.get(source, WIDTH),
+                BOTTOM: self.get(source, HEIGHT), HEIGHT: self.get(source, HEIGHT),
+                CENTER_X: f"{self.get(source, WIDTH)} / 2", CENTER_Y: f"{self.get(source, HEIGHT)} / 2",
+            }[source_attribute]
+            padding = manager.parent.padding
+            if source_type == target_type == Anchor.LEADING and padding:
+                code = f"({code} + {padding!r})"
+            elif source_type == target_type == Anchor.TRAILING and padding:
+                code = f"({code} - {padding!r})"
+        else:
+            if source.parent is None:
+                raise ValueError("Root stack used as a peer")
+            code = self.peer_value(source, source_attribute)
+            gap = manager.managed.gap
+            if source_type == Anchor.LEADING and target_type == Anchor.TRAILING and gap:
+                code = f"({code} - {gap!r})"
+            elif source_type == Anchor.TRAILING and target_type == Anchor.LEADING and gap:
+                code = f"({code} + {gap!r})"
+        return self.modify(anchor._modifiers, code, manager, attribute)
+
+    def peer_value(self, source, attribute):
+        """
+        The value of the attribute as seen by a peer, like Anchor.GETTERS_PEER.
+        """
+        parent = source.parent._anchors
+        if attribute in (LEFT, TOP):
+            _, trailing, size = self.SIZES[AnchorManager.AXIS[attribute]]
+            name = self.variable(source, attribute)
+            return (
+                f"({name} if {name} is not None"
+                f" else {self.get(parent, size)} - {self.get(source, trailing)} - {self.get(source, size)})"
+            )
+        if attribute in (RIGHT, BOTTOM):
+            leading, _, size = self.SIZES[AnchorManager.AXIS[attribute]]
+            name = self.variable(source, attribute)
+            return (
+                f"({self.get(parent, size)} - {name} if {name} is not None"
+                f" else {self.get(source, leading)} + {self.get(source, size)})"
+            )
+        if attribute in (WIDTH, HEIGHT):
+            return self.get(source, attribute)
+        leading, _, size = self.SIZES[AnchorManager.AXIS[attribute]]
+        return f"({self.get(source, leading)} + {self.get(source, size)} / 2)"
+
+    def modify(self, modifiers, code, manager, attribute):
+        if modifiers is None or type(modifiers) is not dict:  # No modifiers, or the placeholder for the source value
+            return code
+        left = self.modify(modifiers["left"], code, manager, attribute)
+        right = modifiers["right"]
+        if type(right) is Anchor or type(right) is dict:
+            right = self.expression(right, manager, attribute)[0]
+        else:
+            right = self.literal(right)
+        return self.operation(modifiers["op"], left, right)
+
+
+class ConditionIndex:
+    """
+    The conditions of a manager's with contexts, indexed so that the common case of comparing an anchor to a constant,
+    like root.width >= 400, only needs the watched value and the interval it falls in between the thresholds.
+    The conditions are evaluated only when an interval is seen for the first time, or if there are other kinds of
+    conditions.
+    """
+
+    THRESHOLD_OPS = {operator.lt, operator.le, operator.gt, operator.ge}
+
+    def __init__(self, conditions):
+        self.watched = {}  # (control id, attribute): [evaluator, thresholds]
+        self.contexts = {}  # context_id: ([(watched key, op, threshold)], [compiled other conditions])
+        self.dependencies = {}  # (manager id, axis): manager
+        self.has_other = False
+        self.stateful = False  # Hysteresis conditions depend on earlier values, not just the current ones
+        self.regions = None
+        self.active_by_regions = {}
+
+        self.wake_at = None  # When a condition waiting for its dwell time should be checked again
+
+        for context_id, condition_lists in conditions.items():
+            simple, other = [], []
+            for condition in (condition for condition_list in condition_lists for condition in condition_list):
+                if condition.get("margin") or condition.get("dwell"):
+                    other.append(HysteresisCondition(condition, self))
+                    self.has_other = True
+                    self.stateful = True
+                elif key := self.add_threshold(condition):
+                    simple.append((key, condition["op"], condition["right"]))
+                else:
+                    other.append(Anchor.compile_value(condition, TOP))
+                    self.has_other = True
+                for control, attribute in Anchor.sources(condition):
+                    self.dependencies[(control._anchors.id, AnchorManager.AXIS[attribute])] = control._anchors
+            self.contexts[context_id] = simple, other
+
+        for watched in self.watched.values():
+            watched[1] = sorted(set(watched[1]))
+
+    @classmethod
+    def is_threshold(cls, condition):
+        if type(condition) is not dict or condition["op"] not in cls.THRESHOLD_OPS:
+            return False
+        anchor, threshold = condition["left"], condition["right"]
+        return not (
+            type(anchor) is not Anchor or type(threshold) not in (int, float) or anchor._control == "constant"
+            or anchor._modifiers is not None or anchor._real_conditions or anchor._share is not None
+            or anchor._max_of or anchor._min_of
+        )
+
+    def add_threshold(self, condition):
+        if not self.is_threshold(condition):
+            return None
+
+        # Plain reference shared by all the thresholds on the same attribute
+        anchor = condition["left"]
+        key = id(anchor._control), anchor._attribute
+        watched = self.watched.setdefault(key, [Anchor.reference(anchor._control, anchor._attribute).compile(TOP), []])
+        watched[1].append(condition["right"])
+        return key
+
+    def active_contexts(self, target, previous, stats=None):
+        self.wake_at = None
+        values = {key: evaluator(target) for key, (evaluator, _) in self.watched.items()}
+        regions = tuple(
+            2 * (index := bisect.bisect_left(thresholds, values[key]))
+            + (index < len(thresholds) and thresholds[index] == values[key])
+            for key, (_, thresholds) in self.watched.items()
+        )
+        if stats:
+            stats.condition_evaluations += len(values)
+        if not self.has_other:
+            if regions == self.regions:
+                return previous
+            if regions in self.active_by_regions:
+                self.regions = regions
+                return self.active_by_regions[regions]
+        self.regions = regions
+
+        active = []
+        for context_id, (simple, other) in self.contexts.items():
+            if all(op(values[key], threshold) for key, op, threshold in simple) and all(
+                check(target) for check in other
             ):
-                self.update_anchors(self.conditional_anchors[context_id])
+                active.append(context_id)
+            if stats:
+                stats.condition_evaluations += len(simple) + len(other)
+        if not self.has_other:
+            self.active_by_regions[regions] = active
+        return active
+
+
+class HysteresisCondition:
+    """
+    Threshold condition that remembers its state, and only flips when the value has crossed the threshold by the
+    margin and stayed there for the dwell time.
+    """
+
+    def __init__(self, condition, index):
+        anchor = condition["left"]
+        self.value = Anchor.reference(anchor._control, anchor._attribute).compile(TOP)
+        self.op = condition["op"]
+        self.threshold = condition["right"]
+        self.direction = 1 if self.op in (operator.gt, operator.ge) else -1  # Which side of the threshold is True
+        self.margin = condition.get("margin", 0)
+        self.dwell = condition.get("dwell", 0)
+        self.index = index
+        self.state = None
+        self.pending_since = None
+
+    def __call__(self, target):
+        value = self.value(target)
+        if self.state is None:
+            self.state = self.op(value, self.threshold)
+            return self.state
+
+        # Move the threshold away from the current state, so that flipping requires crossing it by the margin
+        shifted = self.threshold + self.direction * self.margin * (-1 if self.state else 1)
+        if self.op(value, shifted) == self.state:
+            self.pending_since = None
+            return self.state
+
+        now = time.monotonic()
+        if self.pending_since is None:
+            self.pending_since = now
+        if now - self.pending_since >= self.dwell:
+            self.state = not self.state
+            self.pending_since = None
+        else:
+            wake_at = self.pending_since + self.dwell
+            self.index.wake_at = wake_at if self.index.wake_at is None else min(self.index.wake_at, wake_at)
+        return self.state
+
+
+class ResizeScheduler:
+    """
+    Coalesces a flood of resize events, e.g. from dragging the window edge, so that layout runs at most once per
+    interval with the latest size. The first event after a quiet period is laid out immediately, and the last one
+    of a burst when the interval has passed.
+    """
+
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = None
+        self.timer = None
+        self.last_run = None
+
+    def add(self, width, height):
+        with self.lock:
+            self.pending = width, height
+            if self.timer is not None:  # Flush already scheduled, it will use the latest size
+                return
+
+            wait = 0 if self.last_run is None else self.last_run + self.interval - time.monotonic()
+            if wait > 0:
+                self.timer = threading.Timer(wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+            self.timer = None
+            self.last_run = time.monotonic()
+
+        if pending is not None:
+            self.callback(*pending)
 
 
 class Anchor:
+    """
+    Reference to an attribute of a control, or an expression built from one with operators. Anchors are immutable:
+    operators return new anchors, and equal anchors are the same object, so they can be shared and used as keys.
+    """
+    __slots__ = (
+        "_control", "_attribute", "_modifiers", "_conditions", "_alternative", "_real_conditions", "_max_of",
+        "_min_of", "_share", "_compiled", "__weakref__",
+    )
+
+    INTERNED = weakref.WeakValueDictionary()  # Structure key: anchor, for as long as the anchor is in use
+
+    SOURCE_VALUE = object()  # Stands for the value of the referenced attribute at the start of the modifiers
+
     LEADING, TRAILING, NEUTRAL = "leading", "trailing", "neutral"
 
     ATTRIBUTE_TYPES = {
@@ -473,8 +2687,12 @@ class Anchor:
         ),
     }
 
+    # Stack of (context id, conditions) for the with blocks we are currently in
+    CONDITIONS = contextvars.ContextVar("flet_anchor_conditions", default=())
+
     @dataclass
     class TargetData:
+        __slots__ = ("control", "attribute", "parent")
         control: Anchored
         attribute: str
         parent: Anchored
@@ -483,13 +2701,79 @@ class Anchor:
         self._control = control
         self._attribute = attribute
         self._modifiers = None
-        self._conditions = []
+        self._conditions = ()
         self._alternative = None
         self._real_conditions = False
-        self._max_of = set()
-        self._min_of = set()
-        self._value = None
+        self._max_of = ()
+        self._min_of = ()
         self._share = None
+        self._compiled = None
+
+    @classmethod
+    def reference(cls, control, attribute):
+        """
+        Returns the shared anchor for the attribute of the control, kept by the control's manager.
+        """
+        manager = control._anchors
+        anchor = manager.references.get(attribute)
+        if anchor is None:
+            if manager.references is manager.EMPTY:
+                manager.references = {}
+            anchor = manager.references[attribute] = cls(control, attribute)
+        return anchor
+
+    def _derive(self, **fields):
+        """
+        Returns the interned anchor that equals this one with the given fields changed.
+        """
+        anchor = Anchor.__new__(Anchor)
+        anchor._control = self._control
+        anchor._attribute = self._attribute
+        anchor._modifiers = self._modifiers
+        anchor._conditions = self._conditions
+        anchor._alternative = self._alternative
+        anchor._real_conditions = self._real_conditions
+        anchor._max_of = self._max_of
+        anchor._min_of = self._min_of
+        anchor._share = self._share
+        anchor._compiled = None
+        for field, value in fields.items():
+            setattr(anchor, field, value)
+
+        key_of = self.structure_key
+        key = (
+            id(anchor._control),
+            anchor._attribute,
+            anchor._modifiers and key_of(anchor._modifiers),
+            anchor._conditions and key_of(anchor._conditions),
+            key_of(anchor._alternative),
+            anchor._real_conditions,
+            anchor._max_of and key_of(anchor._max_of),
+            anchor._min_of and key_of(anchor._min_of),
+            anchor._share,
+        )
+        return self.INTERNED.setdefault(key, anchor)
+
+    @classmethod
+    def structure_key(cls, value):
+        """
+        Hashable key that is equal for equal values, comparing anchors by identity as they are interned.
+        """
+        value_type = type(value)
+        if value_type is Anchor or value is cls.SOURCE_VALUE:
+            return id(value)  # Kept alive by the anchor holding the key
+        if value_type is dict:
+            return (
+                value["op"], cls.structure_key(value["left"]), cls.structure_key(value["right"]),
+                value.get("margin"), value.get("dwell"),
+            )
+        if value_type is tuple:
+            return tuple(cls.structure_key(item) for item in value)
+        if value_type is frozenset:
+            return frozenset(cls.structure_key(item) for item in value)
+        if value is None or value_type in (int, float, bool, str):
+            return value_type, value
+        return "id", id(value)
 
     @property
     def current(self):
@@ -497,124 +2781,163 @@ class Anchor:
 
         if current_value is None:
             target_data = Anchor.TargetData(self._control, self._attribute, self._control._anchors.parent)
-            current_value = self._resolve(target_data)
+            current_value = self.compile(self._attribute)(target_data)
 
         return current_value
 
+    @staticmethod
+    def sources(value, conditions=None):
+        """
+        Yields (control, attribute) for every non-constant anchor in the value, including conditions,
+        alternatives and min/max.
+        """
+        seen = set()
+        to_visit = [value]
+        if conditions:
+            to_visit.extend(condition for condition_list in conditions for condition in condition_list)
+        while to_visit:
+            value = to_visit.pop()
+            if type(value) is dict:
+                to_visit.extend((value["left"], value["right"]))
+            elif type(value) is Anchor and id(value) not in seen:
+                seen.add(id(value))
+                if value._control != "constant":
+                    yield value._control, value._attribute
+                to_visit.extend((value._modifiers, value._alternative))
+                to_visit.extend(value._conditions)
+                to_visit.extend(value._max_of)
+                to_visit.extend(value._min_of)
+
     def share(self, share_of, total):
-        self._share = share_of, total
-        return self
+        return self._derive(_share=(share_of, total))
 
     def __str__(self):
         return f"{isinstance(self._control, Anchored) and type(self._control.content).__name__ or self._control}.{self._attribute}"
 
     def _add_modifier(self, op, other):
-        if self._modifiers is None:
-            self._modifiers = lambda: self._value
-
-        self._modifiers = {"op": op, "left": self._modifiers, "right": other}
-
-        return self
-
-    def _resolve(self, target: TargetData, was=None):
-        result = None
-        if self._resolve_conditions(target):
-            if self._control == "constant":
-                result = self._attribute
-            elif self._max_of and was != "max":
-                result = max(self._resolve_many(self._max_of, target, "max"))
-            elif self._min_of and was != "min":
-                result = min(self._resolve_many(self._min_of, target, "min"))
-            else:
-                result = self._resolve_one(target)
-        elif self._alternative:
-            result = self._resolve_alternative(target)
+        modifiers = self.SOURCE_VALUE if self._modifiers is None else self._modifiers
+        return self._derive(_modifiers={"op": op, "left": modifiers, "right": other})
+
+    # Compiled resolving - the expression is walked once, not on every call
+
+    def compile(self, target_attribute):
+        """
+        Returns a function that takes TargetData and returns the value of the anchor for the target attribute.
+        """
+        if self._compiled is None:
+            self._compiled = {}
+        compiled = self._compiled.get(target_attribute)
+        if compiled is None:
+            compiled = self._compiled[target_attribute] = self._compile(target_attribute)
+        return compiled
 
-        if result is None:
-            return None
+    @classmethod
+    def compile_value(cls, value, target_attribute):
+        if type(value) is dict:
+            op = value["op"]
+            left = cls.compile_value(value["left"], target_attribute)
+            right = cls.compile_value(value["right"], target_attribute)
+            return lambda target: op(left(target), right(target))
+        elif type(value) is Anchor:
+            return value.compile(target_attribute)
+        else:
+            return lambda target: value
+
+    def _compile(self, target_attribute):
+        if self._max_of or self._min_of:
+            extreme = max if self._max_of else min
+            parts = [self.compile_value(part, target_attribute) for part in self._max_of or self._min_of]
+            modifiers = self._compile_modifiers(self._modifiers, target_attribute)
+
+            def main(target):
+                result = extreme([part(target) for part in parts])
+                return result if modifiers is None else modifiers(result, target)
+        elif self._control == "constant":
+            constant = self._attribute
+            main = lambda target: constant
+        else:
+            main = self._compile_one(target_attribute)
 
-        if self._share is not None:
-            result = self._apply_share(result, target)
+        if self._real_conditions:
+            checks = [
+                self.compile_value(condition, target_attribute) for condition in self._conditions[0]._conditions
+            ]
+            alternative = None if self._alternative is None else self.compile_value(self._alternative, target_attribute)
+            unconditional = main
 
-        return result
+            def main(target):
+                if all(check(target) for check in checks):
+                    return unconditional(target)
+                return alternative and alternative(target)
 
-    def _resolve_alternative(self, target):
-        if type(self._alternative) is Anchor:
-            return self._alternative._resolve(target)
-        else:
-            return self._alternative
+        if self._share is None:
+            return main
 
-    def _resolve_many(self, anchors, target: TargetData, was=None):
-        return (
-            anchor._resolve(target, was)
-            if type(anchor) is Anchor
-            else anchor
-            for anchor in anchors
-        )
+        share_of, total = self._share
 
-    def _resolve_one(self, target: TargetData):
+        def shared(target):
+            result = main(target)
+            if result is None:
+                return None
+            padding = target.parent._anchors.padding
+            if padding is None:
+                padding = target.parent.DEFAULT_PADDING
+            gap = target.control._anchors.gap
+            if gap is None:
+                gap = target.control.DEFAULT_GAP
+            return ((result - (total - 1) * gap - 2 * padding) / total) * share_of + (share_of - 1) * gap
+
+        return shared
+
+    def _compile_one(self, target_attribute):
         source_control = self._control
-        source_attribute = self._attribute
         source = source_control._anchors
+        source_attribute = self._attribute
         source_type = self.ATTRIBUTE_TYPES[source_attribute]
-        target_type = self.ATTRIBUTE_TYPES[target.attribute]
-
-        if target.control.is_contained_in(source_control):
-            getter = self.GETTERS_PARENT[source_attribute]
-            source_value = getter(source.actuals)
-            if source_type == self.LEADING and target_type == self.LEADING:
-                source_value += target.parent.padding
-            elif source_type == self.TRAILING and target_type == self.TRAILING:
-                source_value -= target.parent.padding
-        else:
-            getter = self.GETTERS_PEER[source_attribute]
-            source_value = getter(source.actuals, source.parent._anchors.actuals)
+        target_type = self.ATTRIBUTE_TYPES[target_attribute]
+        modifiers = self._compile_modifiers(self._modifiers, target_attribute)
 
-            if source_type == self.LEADING and target_type == self.TRAILING:
-                source_value -= target.control.gap
-            elif source_type == self.TRAILING and target_type == self.LEADING:
-                source_value += target.control.gap
-
-        return self._resolve_modifiers(source_value, target)
-
-    def _resolve_modifiers(self, source_value, target: TargetData):
-        if self._modifiers is None:
-            return source_value
-
-        self._value = source_value
-
-        return self._resolve_recursively(self._modifiers, target)
+        padding_sign = (
+            1 if source_type == self.LEADING and target_type == self.LEADING
+            else -1 if source_type == self.TRAILING and target_type == self.TRAILING
+            else 0
+        )
+        gap_sign = (
+            -1 if source_type == self.LEADING and target_type == self.TRAILING
+            else 1 if source_type == self.TRAILING and target_type == self.LEADING
+            else 0
+        )
 
-    def _resolve_conditions(self, target: TargetData):
-        # print(f"{self.conditions=} {self._real_conditions=} {list(self._max_of)=}")
-        if not self._real_conditions:
-            return True
+        def resolve_one(target):
+            if target.parent is source_control:
+                source_value = source.source_value(source_attribute, True)
+                if padding_sign:
+                    source_value += padding_sign * target.parent.padding
+            else:
+                source_value = source.source_value(source_attribute, False)
+                if gap_sign:
+                    source_value += gap_sign * target.control.gap
+            return source_value if modifiers is None else modifiers(source_value, target)
 
-        return all(Anchor._resolve_recursively(condition, target) for condition in self._conditions[0]._conditions)
+        return resolve_one
 
     @classmethod
-    def _resolve_recursively(cls, value, target: TargetData):
-        if type(value) is dict:
-            return value["op"](
-                cls._resolve_recursively(value["left"], target), cls._resolve_recursively(value["right"], target)
-            )
-        elif type(value) is Anchor:
-            return value._resolve(target)
-        elif callable(value):
-            return value()
-        else:
-            return value
-
-    def _apply_share(self, value, target):
-        share_of, total = self._share
-        parent_anchors: AnchorManager = target.parent._anchors
-        target_anchors: AnchorManager = target.control._anchors
-        padding = parent_anchors.padding if parent_anchors.padding is not None else target.parent.DEFAULT_PADDING
-        gap = target_anchors.gap if target_anchors.gap is not None else target.control.DEFAULT_GAP
-
-        final_share = ((value - (total - 1) * gap - 2 * padding) / total) * share_of + (share_of - 1) * gap
+    def _compile_modifiers(cls, modifiers, target_attribute):
+        """
+        Returns a function of (source value, target), or None if there are no modifiers.
+        """
+        if modifiers is None:
+            return None
+        if type(modifiers) is not dict:  # The innermost placeholder for the source value
+            return lambda source_value, target: source_value
 
-        return final_share
+        op = modifiers["op"]
+        left = cls._compile_modifiers(modifiers["left"], target_attribute)
+        right = modifiers["right"]
+        if type(right) is Anchor or type(right) is dict:
+            right = cls.compile_value(right, target_attribute)
+            return lambda source_value, target: op(left(source_value, target), right(target))
+        return lambda source_value, target: op(left(source_value, target), right)
 
     def __add__(self, other):
         return self._add_modifier(operator.add, other)
@@ -656,56 +2979,57 @@ class Anchor:
         return self._add_modifier(operator.pow, other)
 
     def __and__(self, other):
-        other._conditions.append(self)
-        other._real_conditions = True
-        return other
+        return other._derive(_conditions=(*other._conditions, self), _real_conditions=True)
 
     def __or__(self, other):
-        self._alternative = other
-        return self
-
-    # Double duty for conditions and min/max - conditions are only actually used if _real_conditions set (in __add__)
+        return self._derive(_alternative=other)
 
     def __lt__(self, other):
-        self.add_condition(operator.lt, other)
-
-        self._min_of.add(self)
-        if type(other) is Anchor and other._min_of:
-            self._min_of |= other._min_of
-        else:
-            self._min_of.add(other)
-
-        return self
+        return self.add_condition(operator.lt, other)
 
     def __gt__(self, other):
-        self.add_condition(operator.gt, other)
-
-        self._max_of.add(self)
-        if type(other) is Anchor and other._max_of:
-            self._max_of |= other._max_of
-        else:
-            self._max_of.add(other)
+        return self.add_condition(operator.gt, other)
 
-        return self
-
-    # Anchors in min/max must play False in order to come out as the winner
+    # Comparisons only make conditions, so the builtin min() and max() would silently return either argument
     def __bool__(self):
         if self._conditions and not self._real_conditions:
-            return False
+            raise TypeError("Anchor comparisons are conditions, use Anchor.min() and Anchor.max() for the extremes")
 
         return True
 
+    @classmethod
+    def max(cls, *values):
+        """
+        Returns an anchor for the largest of the anchors and numbers.
+        """
+        return cls.extreme("_max_of", max, values)
+
+    @classmethod
+    def min(cls, *values):
+        """
+        Returns an anchor for the smallest of the anchors and numbers.
+        """
+        return cls.extreme("_min_of", min, values)
+
+    @classmethod
+    def extreme(cls, field, function, values):
+        anchors = [value for value in values if type(value) is Anchor]
+        if not anchors:
+            return function(values)
+        if len(values) == 1:
+            return values[0]
+        fields = dict(_modifiers=None, _conditions=(), _alternative=None, _real_conditions=False, _share=None)
+        fields.update(_max_of=(), _min_of=())
+        fields[field] = frozenset(values)
+        return anchors[0]._derive(**fields)
+
     # For conditions
 
     def __le__(self, other):
-        self.add_condition(operator.le, other)
-
-        return self
+        return self.add_condition(operator.le, other)
 
     def __ge__(self, other):
-        self.add_condition(operator.ge, other)
-
-        return self
+        return self.add_condition(operator.ge, other)
 
     # def __eq__(self, other):
     #     self.add_condition(operator.eq, other)
@@ -713,52 +3037,105 @@ class Anchor:
     # def __ne__(self, other):
     #     self.add_condition(operator.ne, other)
 
-    def add_condition(self, operation, other):
-        self._conditions.append({"op": operation, "left": self, "right": other})
+    def add_condition(self, operation, other, margin=0, dwell=0):
+        condition = {"op": operation, "left": self, "right": other}
+        if margin or dwell:
+            condition.update(margin=margin, dwell=dwell)
+        return self._derive(_conditions=(*self._conditions, condition))
+
+    def hysteresis(self, margin=0, dwell=0):
+        """
+        For with-block conditions like (root.width >= 400).hysteresis(20, 0.2): the condition only flips after the
+        value has crossed the threshold by margin, and stayed across it for dwell seconds.
+        """
+        conditions = []
+        for condition in self._conditions:
+            if not ConditionIndex.is_threshold(condition):
+                raise ValueError("hysteresis is only supported for comparisons between an anchor and a number")
+            conditions.append({**condition, "margin": margin, "dwell": dwell})
+        return self._derive(_conditions=tuple(conditions))
 
     # As a context manager
 
+    # The same anchor can be entered in several threads or tasks at once, so nothing is stored on it
     def __enter__(self):
-        frame = inspect.currentframe().f_back.f_back
-        conditions = frame.f_locals.get("_flet_anchor_conditions", {})
-        conditions.setdefault("context_ids", []).append(uuid.uuid4())
-        conditions.setdefault("conditions", []).append(self._conditions)
-        frame.f_locals["_flet_anchor_conditions"] = conditions
+        self.CONDITIONS.set(self.CONDITIONS.get() + ((uuid.uuid4(), self._conditions),))
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        frame = inspect.currentframe().f_back.f_back
-        conditions = frame.f_locals.get("_flet_anchor_conditions")
-        conditions["context_ids"].pop()
-        conditions["conditions"].pop()
-        if not conditions["conditions"]:
-            del frame.f_locals["_flet_anchor_conditions"]
+        self.CONDITIONS.set(self.CONDITIONS.get()[:-1])
 
-    @staticmethod
-    def get_current_conditions():
-        frame = inspect.currentframe()
-        while frame:
-            if conditions := frame.f_locals.get("_flet_anchor_conditions"):
-                context_id = conditions["context_ids"][-1]
-                current_conditions = conditions["conditions"]
-                return context_id, list(current_conditions)
-            frame = frame.f_back
+    @classmethod
+    def get_current_conditions(cls):
+        if stack := cls.CONDITIONS.get():
+            context_id = stack[-1][0]
+            return context_id, [conditions for _, conditions in stack]
         return None
 
 
 class AnchorList(list):
     """
-    Capture append and extend on the controls list in order to make sure the controls know about the parent.
+    Controls list of an AnchorStack that tells the stack which controls each change adds and removes, so that only
+    those are registered or deregistered, with one layout pass per change.
     """
 
+    def __init__(self, stack, controls=()):
+        super().__init__(controls)
+        self.stack = stack
+
     def append(self, item):
         super().append(item)
-
-        self.stack._wrap_controls()
+        self.stack._controls_changed(added=[item])
 
     def extend(self, items):
+        items = list(items)
         super().extend(items)
+        self.stack._controls_changed(added=items)
 
-        self.stack._wrap_controls()
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.stack._controls_changed(added=[item])
+
+    def remove(self, item):
+        super().remove(item)
+        self.stack._controls_changed(removed=[item])
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.stack._controls_changed(removed=[item])
+        return item
+
+    def clear(self):
+        removed = list(self)
+        super().clear()
+        self.stack._controls_changed(removed=removed)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            removed = self[key]
+            value = list(value)
+            added = value
+        else:
+            removed = [self[key]]
+            added = [value]
+        super().__setitem__(key, value)
+        self.stack._controls_changed(added=added, removed=removed)
+
+    def __delitem__(self, key):
+        removed = self[key] if isinstance(key, slice) else [self[key]]
+        super().__delitem__(key)
+        self.stack._controls_changed(removed=removed)
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.stack._controls_changed()
+
+    def reverse(self):
+        super().reverse()
+        self.stack._controls_changed()
 
 
 if __name__ == "__main__":
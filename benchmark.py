@@ -0,0 +1,190 @@
+"""
+Benchmark suite for the anchor engine.
+
+Builds synthetic layouts of growing size against a stand-in page, and measures construction time, time per resize,
+anchor resolves and condition evaluations per resize, _set_attr writes, page updates, peak memory and memory retained
+per control.
+
+Run with: python benchmark.py [--sizes 10 50 100] [--resizes 20] [--compiled] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import flet as ft
+
+import anchor as a
+
+
+class StandInPage:
+    """
+    Takes the place of ft.Page, counting the updates instead of sending them to a client.
+    """
+
+    def __init__(self):
+        self.update_calls = 0
+        self.updated_controls = 0
+
+    def update(self, *controls):
+        self.update_calls += 1
+        self.updated_controls += len(controls)
+
+    async def update_async(self, *controls):
+        self.update(*controls)
+
+
+def chain(root, n):
+    """
+    n controls, each docked below the previous one.
+    """
+    controls = [a.Anchored(ft.Container(), dock_top=root, height=20)]
+    for _ in range(n - 1):
+        controls.append(a.Anchored(ft.Container(), dock_below=controls[-1], width=root.width / 2, height=20))
+    return controls
+
+
+def grid(root, n):
+    """
+    n x n cells sized with share().
+    """
+    controls = []
+    previous_row = None
+    for _ in range(n):
+        row = []
+        for column in range(n):
+            row.append(a.Anchored(
+                ft.Container(),
+                left=row[-1].right if row else root.left,
+                top=previous_row[column].bottom if previous_row else root.top,
+                width=root.width.share(1, n),
+                height=root.height.share(1, n),
+            ))
+        controls.extend(row)
+        previous_row = row
+    return controls
+
+
+def diamond(root, n):
+    """
+    n layers where two siblings depend on the previous layer and a third one depends on both of them.
+    """
+    header = a.Anchored(ft.Container(), dock_top=root, height=20)
+    controls = [header]
+    previous = header
+    for _ in range(n):
+        left = a.Anchored(ft.Container(), top=previous.bottom, left=root.left, width=root.width / 3, height=10)
+        right = a.Anchored(ft.Container(), top=previous.bottom, right=root.right, width=root.width / 3, height=10)
+        joined = a.Anchored(
+            ft.Container(), top=a.Anchor.max(left.bottom, right.bottom), left=left.right, right=right.left
+        )
+        controls.extend((left, right, joined))
+        previous = joined
+    return controls
+
+
+def breakpoints(root, n):
+    """
+    20 controls with n width breakpoints, each breakpoint its own with block.
+    """
+    controls = [a.Anchored(ft.Container(), top=root.top + 30 * i, left=root.left) for i in range(20)]
+    step = 1600 / n
+    for i in range(n):
+        with root.width >= i * step:
+            with root.width < (i + 1) * step:
+                for control in controls:
+                    control.width = root.width / (i + 2)
+    return controls
+
+
+def vector_grid(root, n):
+    """
+    The same n x n cells as grid, placed by an AnchorGrid instead of share() anchors.
+    """
+    cells = a.AnchorGrid(dock_all=root, columns=n, gap=a.Anchored.DEFAULT_GAP)
+    cells.controls = [a.Anchored(ft.Container()) for _ in range(n * n)]
+    return [cells]
+
+
+LAYOUTS = {
+    "chain": chain,
+    "grid": grid,
+    "diamond": diamond,
+    "breakpoints": breakpoints,
+    "vector_grid": vector_grid,
+}
+
+
+def measure(layout, n, resizes, compiled=False):
+    a.Anchored.RESIZE_INTERVAL = 0  # Measure every resize
+    page = StandInPage()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    root = a.AnchorStack()
+    root.page = page
+    controls = LAYOUTS[layout](root, n)
+    root.controls = controls
+    for control in root._anchors.descendants():
+        control.page = page
+    root._anchors.resize(1000, 800)
+    construction = time.perf_counter() - start
+    count = sum(1 for _ in root._anchors.descendants())
+    retained_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    page.update_calls = page.updated_controls = 0
+    stats = root.enable_stats()
+    if compiled:
+        root.enable_compiled_layout()
+    start = time.perf_counter()
+    for i in range(resizes):
+        root._anchors.resize(600 + (i % 2) * 400 + i, 800)
+    resize_time = time.perf_counter() - start
+
+    return {
+        "layout": layout,
+        "n": n,
+        "compiled": compiled,
+        "controls": count,
+        "construction_s": construction,
+        "resize_s": resize_time / resizes,
+        "solve_s": stats.solve_duration / resizes,
+        "resolves_per_resize": stats.resolves / resizes,
+        "condition_evaluations_per_resize": stats.condition_evaluations / resizes,
+        "set_attrs_per_resize": stats.set_attrs / resizes,
+        "page_updates_per_resize": page.update_calls / resizes,
+        "updated_controls_per_resize": page.updated_controls / resizes,
+        "peak_memory_bytes": peak_memory,
+        "memory_per_control_bytes": retained_memory / count,
+    }
+
+
+def run(sizes, resizes, layouts=None, compiled=False):
+    return {
+        "python": platform.python_version(),
+        "flet": getattr(ft, "__version__", None) or getattr(ft.version, "version", None),
+        "results": [
+            measure(layout, n, resizes, compiled)
+            for layout in (layouts or LAYOUTS)
+            for n in (sizes if "grid" not in layout else [max(1, int(size ** 0.5)) for size in sizes])
+        ],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--resizes", type=int, default=20)
+    parser.add_argument("--layouts", nargs="+", choices=list(LAYOUTS))
+    parser.add_argument("--compiled", action="store_true", help="Resize with the generated layout function")
+    parser.add_argument("--output", help="File to write the JSON results to, default is stdout")
+    args = parser.parse_args()
+
+    results = json.dumps(run(args.sizes, args.resizes, args.layouts, args.compiled), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(results)
+    else:
+        print(results)
@@ -0,0 +1,150 @@
+"""
+Microbenchmark comparing a reference evaluator that walks the anchor expression on every call with the compiled
+evaluators from Anchor.compile.
+
+Run with: python benchmark_compile.py
+"""
+import timeit
+
+import flet as ft
+
+import anchor as a
+from anchor import Anchor
+
+
+def resolve(anchor, target):
+    """
+    Value of the anchor for the target, walking the whole expression.
+    """
+    result = None
+    if conditions_hold(anchor, target):
+        if anchor._max_of or anchor._min_of:
+            extreme = max if anchor._max_of else min
+            result = extreme(resolve_value(part, target) for part in anchor._max_of or anchor._min_of)
+            result = modify(anchor, target, result)
+        elif anchor._control == "constant":
+            result = anchor._attribute
+        else:
+            result = resolve_one(anchor, target)
+    elif anchor._alternative is not None:
+        result = resolve_value(anchor._alternative, target)
+
+    if result is None or anchor._share is None:
+        return result
+    return apply_share(anchor, result, target)
+
+
+def conditions_hold(anchor, target):
+    if not anchor._real_conditions:
+        return True
+    return all(resolve_value(condition, target) for condition in anchor._conditions[0]._conditions)
+
+
+def resolve_value(value, target, source_value=None):
+    if type(value) is dict:
+        return value["op"](
+            resolve_value(value["left"], target, source_value),
+            resolve_value(value["right"], target, source_value),
+        )
+    elif type(value) is Anchor:
+        return resolve(value, target)
+    elif value is Anchor.SOURCE_VALUE:
+        return source_value
+    else:
+        return value
+
+
+def resolve_one(anchor, target):
+    source_control = anchor._control
+    source = source_control._anchors
+    source_type = Anchor.ATTRIBUTE_TYPES[anchor._attribute]
+    target_type = Anchor.ATTRIBUTE_TYPES[target.attribute]
+
+    if target.parent is source_control:
+        source_value = Anchor.GETTERS_PARENT[anchor._attribute](source.actuals)
+        if source_type == Anchor.LEADING and target_type == Anchor.LEADING:
+            source_value += target.parent.padding
+        elif source_type == Anchor.TRAILING and target_type == Anchor.TRAILING:
+            source_value -= target.parent.padding
+    else:
+        source_value = Anchor.GETTERS_PEER[anchor._attribute](source.actuals, source.parent._anchors.actuals)
+        if source_type == Anchor.LEADING and target_type == Anchor.TRAILING:
+            source_value -= target.control.gap
+        elif source_type == Anchor.TRAILING and target_type == Anchor.LEADING:
+            source_value += target.control.gap
+
+    return modify(anchor, target, source_value)
+
+
+def modify(anchor, target, source_value):
+    if anchor._modifiers is None:
+        return source_value
+    return resolve_value(anchor._modifiers, target, source_value)
+
+
+def apply_share(anchor, value, target):
+    share_of, total = anchor._share
+    padding = target.parent.padding
+    gap = target.control.gap
+    return ((value - (total - 1) * gap - 2 * padding) / total) * share_of + (share_of - 1) * gap
+
+
+def build():
+    root = a.AnchorStack()
+    root._anchors.actuals.update(width=800, height=600)
+    header = a.Anchored(ft.Container())
+    target = a.Anchored(ft.Container())
+    root.controls = [header, target]
+    header._anchors.actuals.update(left=0, top=0, width=800, height=50)
+
+    expressions = {
+        "plain": lambda: (header.bottom, a.TOP),
+        "modifiers": lambda: ((root.width - 20) / 3 * 2 + 5, a.WIDTH),
+        "peer_modifiers": lambda: (header.bottom + header.height / 2 - 1, a.TOP),
+        "condition": lambda: ((root.width >= 600) & root.width / 2 | root.width / 4, a.CENTER_X),
+        "share": lambda: (root.width.share(2, 3), a.WIDTH),
+        "max": lambda: (a.Anchor.max(header.bottom, root.height / 4, 100), a.TOP),
+    }
+    return root, header, target, expressions
+
+
+def check_extremes(root, header, target):
+    """
+    Anchor.max and Anchor.min resolve to the real extreme, whichever argument it is.
+    """
+    target_data = a.Anchor.TargetData(target, a.TOP, root)
+    below_header = header.bottom.compile(a.TOP)(target_data)
+    for anchor, expected in (
+        (a.Anchor.max(root.center_x, 300), 400),
+        (a.Anchor.max(300, header.bottom), 300),
+        (a.Anchor.min(root.width / 2, 200), 200),
+        (a.Anchor.min(header.bottom, 200), below_header),
+        (a.Anchor.max(a.Anchor.min(root.width, 30), 20) * 2, 60),
+    ):
+        assert anchor.compile(a.TOP)(target_data) == expected, (anchor, expected)
+
+
+def run(number=20000):
+    root, header, target, expressions = build()
+    check_extremes(root, header, target)
+    results = {}
+    for name, expression in expressions.items():
+        anchor, attribute = expression()
+        target_data = a.Anchor.TargetData(target, attribute, root)
+        compiled = anchor.compile(attribute)
+        assert resolve(anchor, target_data) == compiled(target_data), name
+
+        walking = min(timeit.repeat(lambda: resolve(anchor, target_data), number=number, repeat=3))
+        precompiled = min(timeit.repeat(lambda: compiled(target_data), number=number, repeat=3))
+        results[name] = walking, precompiled
+    return results
+
+
+if __name__ == "__main__":
+    number = 20000
+    print(f"{'expression':<16}{'tree walk µs':>14}{'compiled µs':>14}{'speedup':>10}")
+    for name, (walking, precompiled) in run(number).items():
+        print(
+            f"{name:<16}{walking / number * 1e6:>14.2f}{precompiled / number * 1e6:>14.2f}"
+            f"{walking / precompiled:>9.1f}x"
+        )
@@ -0,0 +1,125 @@
+"""
+Checks that the compiled layout gives the same boxes as the usual solve.
+
+Builds each layout twice, turns on compiled layout for one of them, and solves both with AnchorStack.solve for a range
+of root sizes, comparing the box of every control. Covers the benchmark layouts plus with-block and & | conditions,
+nested stacks, share() and min/max.
+
+Run with: python check_compiled.py [--layouts nested share] [--n 4]
+"""
+import argparse
+import math
+
+import flet as ft
+
+import anchor as a
+import benchmark
+
+SIZES = [(width, height) for width in (250, 399, 400, 401, 599, 600, 800, 1203) for height in (300, 500, 801)]
+
+
+def conditional(root, n):
+    """
+    n controls that switch anchors in with blocks and with & | conditions.
+    """
+    menu = a.Anchored(ft.Container(), dock_top=root, height=40)
+    controls = [menu]
+    for i in range(n):
+        with root.width >= 400 + 100 * i:
+            control = a.Anchored(
+                ft.Container(), top=controls[-1].bottom, left=root.left, width=root.width / 3, height=30
+            )
+        with root.width < 400 + 100 * i:
+            control.dock_below = controls[-1]
+            control.width = root.width / 4
+            control.height = (root.height > 500) & root.height / 10 | 20
+        control.center_x = (root.width >= 600) & root.width / 2 | root.width / 4
+        controls.append(control)
+    return controls
+
+
+def nested(root, n):
+    """
+    n stacks in a row, each with a header docked at the top and a footer below it.
+    """
+    stacks = []
+    for i in range(n):
+        stack = a.AnchorStack(
+            top=root.top + 10 * i,
+            left=stacks[-1].right if stacks else root.left,
+            width=root.width.share(1, n),
+            bottom=root.bottom,
+        )
+        header = a.Anchored(ft.Container(), dock_top=stack, height=stack.height / 4)
+        footer = a.Anchored(ft.Container(), dock_below=header, width=stack.width / 2, height=30)
+        stack.controls = [header, footer]
+        stacks.append(stack)
+    return stacks
+
+
+def share(root, n):
+    """
+    n columns sized with share(), and a control under them bounded with min and max.
+    """
+    columns = []
+    for i in range(n):
+        columns.append(a.Anchored(
+            ft.Container(),
+            left=columns[-1].right if columns else root.left,
+            top=root.top,
+            width=root.width.share(1, n),
+            height=a.Anchor.min(root.height / 2, 300),
+        ))
+    footer = a.Anchored(
+        ft.Container(), top=a.Anchor.max(columns[0].bottom, 200), left=root.left,
+        width=a.Anchor.max(root.width.share(2, 3), 300),
+    )
+    return [*columns, footer]
+
+
+LAYOUTS = {
+    **benchmark.LAYOUTS,
+    "conditional": conditional,
+    "nested": nested,
+    "share": share,
+}
+
+
+def check(layout, n):
+    """
+    Returns a list of (size, control index, usual box, compiled box) for the boxes that differ.
+    """
+    roots = []
+    for compiled in (False, True):
+        root = a.AnchorStack()
+        root.controls = LAYOUTS[layout](root, n)
+        if compiled:
+            root.enable_compiled_layout()
+            stats = root.enable_stats()
+        roots.append(root)
+
+    differences = []
+    for size in SIZES:
+        usual, compiled = (list(root.solve(*size).values()) for root in roots)
+        for index, (expected, actual) in enumerate(zip(usual, compiled)):
+            if any(not math.isclose(expected[key], actual[key], abs_tol=1e-9) for key in expected):
+                differences.append((size, index, expected, actual))
+    if stats.compiled_passes != len(SIZES):
+        raise AssertionError(f"{layout}: only {stats.compiled_passes} of {len(SIZES)} solves were compiled")
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--layouts", nargs="+", choices=list(LAYOUTS), default=list(LAYOUTS))
+    parser.add_argument("--n", type=int, default=4, help="size parameter of each layout")
+    args = parser.parse_args()
+
+    failed = False
+    for layout in args.layouts:
+        differences = check(layout, args.n)
+        print(f"{layout:<14}{'ok' if not differences else f'{len(differences)} differences'}")
+        for size, index, expected, actual in differences[:5]:
+            print(f"    {size} control {index}: {expected} != {actual}")
+        failed = failed or bool(differences)
+    raise SystemExit(1 if failed else 0)
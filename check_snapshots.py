@@ -0,0 +1,69 @@
+"""
+Checks that restoring layout snapshots gives the same boxes as the usual solve.
+
+Builds each layout twice on a stand-in page, enables snapshots for one of them, and resizes both through the same
+sequence of fractional root sizes, going back and forth across the breakpoints of the layouts, comparing the box of
+every control after each resize. Snapshots are stored by the size rounded to whole pixels, so the boxes only have to
+agree to within a pixel, while a snapshot from the wrong side of a breakpoint is far off.
+
+Run with: python check_snapshots.py [--layouts conditional breakpoints] [--n 4]
+"""
+import argparse
+import math
+
+import anchor as a
+import benchmark
+import check_compiled
+
+WIDTHS = (800, 399.6, 800, 400.2, 599.7, 600.3, 250, 399.6, 400.2, 800.4, 599.7, 800, 600.3, 1203)
+HEIGHTS = (500.2, 499.8, 500.2, 801)
+SIZES = [(width, HEIGHTS[index % len(HEIGHTS)]) for index, width in enumerate(WIDTHS * 2)]
+
+
+def check(layout, n):
+    """
+    Returns a list of (size, control index, usual box, restored box) for the boxes that differ, and the number of
+    resizes that were served from a snapshot.
+    """
+    a.Anchored.RESIZE_INTERVAL = 0
+    roots = []
+    for snapshots in (False, True):
+        page = benchmark.StandInPage()
+        root = a.AnchorStack()
+        root.page = page
+        root.controls = check_compiled.LAYOUTS[layout](root, n)
+        for control in root._anchors.descendants():
+            control.page = page
+        if snapshots:
+            root.enable_snapshots()
+            stats = root.enable_stats()
+        roots.append(root)
+
+    differences = []
+    for size in SIZES:
+        boxes = []
+        for root in roots:
+            root._anchors.resize(*size)
+            boxes.append([a.AnchorManager.box(control) for control in root._anchors.descendants()])
+        for index, (expected, actual) in enumerate(zip(*boxes)):
+            if any(not math.isclose(expected[key], actual[key], abs_tol=1) for key in expected):
+                differences.append((size, index, expected, actual))
+    return differences, stats.snapshot_hits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--layouts", nargs="+", choices=list(check_compiled.LAYOUTS), default=list(check_compiled.LAYOUTS)
+    )
+    parser.add_argument("--n", type=int, default=4, help="size parameter of each layout")
+    args = parser.parse_args()
+
+    failed = False
+    for layout in args.layouts:
+        differences, hits = check(layout, args.n)
+        print(f"{layout:<14}{'ok' if not differences else f'{len(differences)} differences'}, {hits} snapshot hits")
+        for size, index, expected, actual in differences[:5]:
+            print(f"    {size} control {index}: {expected} != {actual}")
+        failed = failed or bool(differences)
+    raise SystemExit(1 if failed else 0)
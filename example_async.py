@@ -0,0 +1,24 @@
+import anchor as a
+import flet as ft
+
+
+async def main(page: ft.Page):
+    page.padding = 0
+    await page.add_async(root := a.AnchorStack(expand=True))
+    root.enable_async()
+
+    app_bar = a.Anchored(ft.Container(bgcolor=ft.colors.RED_100), height=50)
+    content_area = a.Anchored(ft.Container(bgcolor=ft.colors.GREEN_100))
+
+    app_bar.dock_top = root
+    content_area.top = app_bar.bottom
+    content_area.dock_bottom = root
+
+    with root.width >= 600:
+        content_area.dock_left = root
+        content_area.width = root.width / 2
+
+    root.controls = [app_bar, content_area]
+
+
+ft.app(main)
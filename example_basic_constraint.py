@@ -9,7 +9,7 @@ def main(page: ft.Page):
     # on_the_side = a.Anchored(ft.FilledButton("On the side"), top=center.top, left=center.right)
     # one_quarter_from_the_top = a.Anchored(ft.FilledButton("1/4 height"), center_x=root.center_x, center_y=root.height / 4)
     # adjusted = a.Anchored(ft.FilledButton("Adjusted"), center_x=root.width * 3/4, center_y=20 + root.height / 4)
-    # max_position = a.Anchored(ft.FilledButton("Max position"), center_y=root.height * 3/4, center_x=max(root.center_x, 300))
+    # max_position = a.Anchored(ft.FilledButton("Max position"), center_y=root.height * 3/4, center_x=a.Anchor.max(root.center_x, 300))
     reactive = a.Anchored(
         ft.FilledButton("Condition"),
         center_x=(root.width >= 600) & root.width/2 | root.width/4,
@@ -0,0 +1,17 @@
+import anchor as a
+import flet as ft
+
+
+def main(page: ft.Page):
+    page.add(root := a.AnchorStack(expand=True))
+
+    header = a.Anchored(ft.Container(bgcolor=ft.colors.BLUE_GREY_100), dock_top=root, height=50)
+    grid = a.AnchorGrid(columns=20, padding=10, dock_bottom=root, top=header.bottom)
+    root.controls.extend([header, grid])
+
+    grid.controls.extend(
+        a.Anchored(ft.Container(bgcolor=ft.colors.BLUE_200 if i % 2 else ft.colors.BLUE_400)) for i in range(400)
+    )
+
+
+ft.app(main)
@@ -0,0 +1,27 @@
+import anchor as a
+import flet as ft
+
+
+def create(item):
+    return a.Anchored(ft.Text(item))
+
+
+def recycle(control, item):
+    control.content.value = item
+
+
+def main(page: ft.Page):
+    page.add(root := a.AnchorStack(expand=True))
+
+    items = [f"Item {i}" for i in range(100_000)]
+    slider = a.Anchored(ft.Slider(min=0, max=1), dock_bottom=root, height=50)
+    grid = a.AnchorVirtualGrid(
+        items, create, recycle, item_height=30, columns=4, dock_top=root, bottom=slider.top
+    )
+    slider.content.on_change = lambda event: setattr(
+        grid, "scroll_offset", float(event.control.value) * grid.content_height
+    )
+    root.controls.extend([grid, slider])
+
+
+ft.app(main)